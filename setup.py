@@ -76,11 +76,14 @@ setup(
         'tracsubtickets': [
             'htdocs/css/*.css',
             'htdocs/js/*.js',
+            'templates/*.html',
+            'templates/genshi/*.html',
             'locale/*/LC_MESSAGES/*.mo',
         ],
     },
     entry_points={
         'trac.plugins': [
+            'tracsubtickets.admin = tracsubtickets.admin',
             'tracsubtickets.api = tracsubtickets.api',
             'tracsubtickets.web_ui = tracsubtickets.web_ui',
         ],
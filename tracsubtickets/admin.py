@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Takashi Ito
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
+from trac.core import Component, implements
+from trac.util.text import printout
+
+from .api import SubTicketsSystem, _, _chunks
+from .checker import check_subtickets
+from .export import FORMATS
+
+# number of tickets repaired per transaction by `subtickets resync`
+RESYNC_CHUNK_SIZE = 1000
+
+
+class SubTicketsAdmin(Component):
+    """trac-admin commands for the subtickets plugin."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('subtickets notify', '[limit]',
+               """Send the queued subticket notifications
+
+               Sends the notifications which are due in the queue filled
+               when the `[subtickets] notification_queue` option is
+               enabled. At most `limit` notifications are sent if given.
+               """,
+               None, self._do_notify)
+        yield ('subtickets resync', '<field|table> [--dry-run]',
+               """Resynchronize the parents field and the subtickets table
+
+               With `field`, the `subtickets` table is rebuilt from the
+               `parents` custom field of the tickets. With `table`, the
+               `parents` field is rewritten from the `subtickets` table.
+               Only the tickets where both differ are changed, a chunk
+               at a time, without adding comments to the tickets nor
+               sending notifications. With `--dry-run`, the changes are
+               only listed.
+               """,
+               self._complete_resync, self._do_resync)
+        yield ('subtickets export',
+               '<ndjson|csv|dot> [--root=<id>] [--fields=<field,...>]',
+               """Export the subtickets relations
+
+               Writes all the relations, or those below the ticket
+               `--root`, to the standard output as newline-delimited JSON,
+               CSV or a Graphviz digraph. The values of the ticket fields
+               given by `--fields` are added for both tickets of each
+               relation. The relations are read by batches, so that
+               memory use does not grow with their number.
+               """,
+               self._complete_export, self._do_export)
+
+    def _complete_resync(self, args):
+        if len(args) == 1:
+            return ['field', 'table']
+        if len(args) == 2:
+            return ['--dry-run']
+
+    def _complete_export(self, args):
+        if len(args) == 1:
+            return sorted(FORMATS)
+        return ['--root=', '--fields=']
+
+    def _do_notify(self, limit=None):
+        sent, failed = SubTicketsSystem(self.env).process_notification_queue(
+            int(limit) if limit else None)
+        printout(_("%(sent)s notifications sent, %(failed)s failed.",
+                   sent=sent, failed=failed))
+
+    def _do_resync(self, source, *args):
+        if source not in ('field', 'table') or \
+                any(arg != '--dry-run' for arg in args):
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        dry_run = '--dry-run' in args
+
+        with self.env.db_query as db:
+            ids = [id for id, cfield, subtickets in check_subtickets(db)]
+        done = 0
+        for chunk in _chunks(ids, RESYNC_CHUNK_SIZE):
+            with self.env.db_transaction as db:
+                # the tickets may have changed in the meantime
+                mismatches = list(check_subtickets(db, chunk))
+                if dry_run:
+                    for id, cfield, subtickets in mismatches:
+                        old, new = subtickets, cfield
+                        if source == 'table':
+                            old, new = new, old
+                        printout(_("#%(id)s: %(old)s -> %(new)s", id=id,
+                                   old=_format_parents(old),
+                                   new=_format_parents(new)))
+                elif source == 'field':
+                    self._resync_table(db, mismatches)
+                else:
+                    self._resync_field(db, mismatches)
+            done += len(mismatches)
+            if not dry_run:
+                printout(_("%(done)s/%(total)s tickets resynchronized",
+                           done=done, total=len(ids)))
+
+        if dry_run:
+            printout(_("%(count)s tickets would be resynchronized.",
+                       count=done))
+        elif source == 'field' and done:
+            SubTicketsSystem(self.env).relations_reset()
+
+    def _do_export(self, format, *args):
+        if format not in FORMATS:
+            raise AdminCommandError(_("Invalid arguments"), show_usage=True)
+        system = SubTicketsSystem(self.env)
+        root = None
+        fields = []
+        for arg in args:
+            name, sep, value = arg.partition('=')
+            if name == '--root' and value.isdigit() and \
+                    0 < int(value) <= 1 << 31:
+                root = int(value)
+            elif name == '--fields' and value:
+                fields = [field.strip() for field in value.split(',')]
+            else:
+                raise AdminCommandError(_("Invalid arguments"),
+                                        show_usage=True)
+        unknown = set(fields) - set(system.get_field_names())
+        if unknown:
+            raise AdminCommandError(_("Unknown fields %(fields)s",
+                                      fields=', '.join(sorted(unknown))))
+        function = FORMATS[format][0]
+        for line in function(system.export_relations(root, fields), fields):
+            printout(line, newline=False)
+
+    def _resync_table(self, db, mismatches):
+        removed = []
+        added = []
+        for id, cfield, subtickets in mismatches:
+            cfield = cfield or set()
+            subtickets = subtickets or set()
+            removed.extend((parent, id) for parent in subtickets - cfield)
+            added.extend((parent, id) for parent in cfield - subtickets)
+        if removed:
+            db.executemany("""
+                DELETE FROM subtickets WHERE parent=%s AND child=%s
+                """, removed)
+        if added:
+            db.executemany("""
+                INSERT INTO subtickets (parent, child) VALUES (%s, %s)
+                """, added)
+
+    def _resync_field(self, db, mismatches):
+        ids = [id for id, cfield, subtickets in mismatches]
+        existing = set(id for id, in db("""
+            SELECT id FROM ticket WHERE id IN ({0})
+            """.format(','.join(['%s'] * len(ids))), ids)) if ids else set()
+        updated = []
+        inserted = []
+        for id, cfield, subtickets in mismatches:
+            value = ', '.join(str(parent)
+                              for parent in sorted(subtickets or ()))
+            if cfield is not None:
+                updated.append((value, id))
+            elif id in existing:
+                inserted.append((id, value))
+        if updated:
+            db.executemany("""
+                UPDATE ticket_custom SET value=%s
+                WHERE ticket=%s AND name='parents'
+                """, updated)
+        if inserted:
+            db.executemany("""
+                INSERT INTO ticket_custom (ticket, name, value)
+                VALUES (%s, 'parents', %s)
+                """, inserted)
+
+
+def _format_parents(parents):
+    return ', '.join(str(id) for id in sorted(parents)) if parents else '--'
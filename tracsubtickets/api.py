@@ -27,18 +27,31 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import importlib
+import inspect
 import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
 
 import pkg_resources
 
-from trac.config import BoolOption
+from trac.cache import cached
+from trac.config import BoolOption, FloatOption, IntOption, ListOption
 from trac.core import Component, implements
 from trac.db import DatabaseManager
+from trac.db.util import IterableCursor
 from trac.env import IEnvironmentSetupParticipant
 from trac.resource import ResourceNotFound
-from trac.ticket.api import ITicketChangeListener, ITicketManipulator
+from trac.ticket.api import (ITicketChangeListener, ITicketManipulator,
+                             TicketSystem)
 from trac.ticket.model import Ticket
-from trac.util.text import exception_to_unicode
+from trac.util.datefmt import from_utimestamp, to_utimestamp, utc
+from trac.util.text import empty, exception_to_unicode
 from trac.util.translation import domain_functions
 try:
     TicketNotifyEmail = None
@@ -48,17 +61,143 @@ except ImportError:
     NotificationSystem = TicketChangeEvent = None
     from trac.ticket.notification import TicketNotifyEmail
 
-from . import db_default
+from . import db_default, upgrades
 
 
 NUMBERS_RE = re.compile(r'\d+', re.U)
 
+# keep the number of bound parameters below SQLite's default limit (999)
+IN_CLAUSE_SIZE = 500
+
+# microseconds a queued notification is reserved for the process sending
+# it, and before its first retry
+QUEUE_LEASE = 10 * 60 * 1000000
+QUEUE_RETRY_DELAY = 60 * 1000000
+
+# relations read by the single statement loading a page of a subtree,
+# per ticket of the page, before `get_tree_page` pages level by level
+PAGE_EDGES_FACTOR = 10
+
+# rows read per statement by `export_relations` and `query_tickets`
+EXPORT_BATCH_SIZE = 1000
+
+# upper bounds in seconds of the latency histogram buckets
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
 # i18n support for plugins, available since Trac r7705
 # use _, tag_ and N_ as usual, e.g. _("this is a message text")
 _, tag_, N_, add_domain = domain_functions('tracsubtickets',
                                            '_', 'tag_', 'N_', 'add_domain')
 
 
+_query_count = threading.local()
+_query_listeners = []
+_query_hook_lock = threading.Lock()
+
+
+def _install_query_hook():
+    """Make Trac's cursors count the statements they execute in the
+    current thread, and pass them to the `_query_listeners`.
+
+    The cursor methods are replaced once and for all, so that the
+    statements are seen by both the instrumentation and `record_queries`
+    whatever the order in which they start and stop.
+    """
+    with _query_hook_lock:
+        if getattr(IterableCursor, '_subtickets_counting', False):
+            return
+        execute = IterableCursor.execute
+        executemany = IterableCursor.executemany
+
+        def counting_execute(cursor, sql, args=None):
+            _query_executed(sql)
+            return execute(cursor, sql, args)
+
+        def counting_executemany(cursor, sql, args):
+            _query_executed(sql)
+            return executemany(cursor, sql, args)
+
+        IterableCursor.execute = counting_execute
+        IterableCursor.executemany = counting_executemany
+        IterableCursor._subtickets_counting = True
+
+
+def _query_executed(sql):
+    _query_count.value = getattr(_query_count, 'value', 0) + 1
+    for listener in list(_query_listeners):
+        listener(sql)
+
+
+@contextmanager
+def record_queries():
+    """Context manager returning the list of the SQL statements executed
+    through Trac's cursors while it is active, in any thread.
+    """
+    _install_query_hook()
+    queries = []
+    listener = queries.append
+    with _query_hook_lock:
+        _query_listeners.append(listener)
+    try:
+        yield queries
+    finally:
+        with _query_hook_lock:
+            _query_listeners[:] = [other for other in _query_listeners
+                                   if other is not listener]
+
+
+def instrumented(nodes=None, result_nodes=None, name=None):
+    """Decorate a method of a component so that its calls are recorded by
+    `SubTicketsSystem.record_call` when instrumentation is enabled.
+
+    The number of tickets involved is computed by `nodes` from the
+    arguments of the call, or by `result_nodes` from its result. The
+    calls are recorded under `name` if given, or under the name of the
+    method.
+
+    The wrapper does not keep the signature of the method, so extension
+    point methods whose arity Trac checks, like `post_process_request`,
+    have to delegate to an instrumented method instead.
+    """
+    def decorator(func):
+        def probe(self, args, kwargs):
+            system = SubTicketsSystem(self.env)
+            if not system.opt_instrumentation:
+                return None
+            _install_query_hook()
+            return (system, getattr(_query_count, 'value', 0), time.time(),
+                    nodes(*args, **kwargs) if nodes else 0)
+
+        def record(self, state, result=None):
+            system, queries, start, count = state
+            if result_nodes:
+                count = result_nodes(result)
+            system.record_call('%s.%s' % (type(self).__name__,
+                                          name or func.__name__),
+                               time.time() - start,
+                               getattr(_query_count, 'value', 0) - queries,
+                               count)
+
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def wrapper(self, *args, **kwargs):
+                state = probe(self, args, kwargs)
+                for item in func(self, *args, **kwargs):
+                    yield item
+                if state:
+                    record(self, state)
+        else:
+            @wraps(func)
+            def wrapper(self, *args, **kwargs):
+                state = probe(self, args, kwargs)
+                result = func(self, *args, **kwargs)
+                if state:
+                    record(self, state, result)
+                return result
+        return wrapper
+    return decorator
+
+
 class SubTicketsSystem(Component):
 
     implements(IEnvironmentSetupParticipant,
@@ -75,8 +214,78 @@ class SubTicketsSystem(Component):
         any modification unconditionally.
         """))
 
+    opt_closure_table = BoolOption(
+        'subtickets', 'closure_table', default='false',
+        doc=_("""If `True`, maintain the `subtickets_closure` table holding
+        every ancestor/descendant pair with its distance, and answer
+        hierarchy queries with a single lookup in it. The table is
+        rebuilt the first time it is used after being enabled.
+        """))
+
+    opt_tree_cache_size = IntOption(
+        'subtickets', 'tree_cache_size', default=100,
+        doc=_("""Number of subtrees kept in memory by each process, so that
+        views of the same tickets do not query their descendants again.
+        The cache is emptied in all processes whenever a relation changes.
+        `0` disables the cache.
+        """))
+
+    opt_rollup = BoolOption(
+        'subtickets', 'rollup', default='false',
+        doc=_("""If `True`, the subtickets header of a ticket shows how many
+        of all its descendants are closed, with their number per status,
+        and the sums of the `rollup_fields` over them.
+        """))
+
+    opt_rollup_fields = ListOption(
+        'subtickets', 'rollup_fields', default='',
+        doc=_("""Comma-separated list of numeric custom fields, such as
+        `estimatedhours`, whose values are summed over the descendants
+        of a ticket when `rollup` is enabled.
+        """))
+
+    opt_last_child_comment = BoolOption(
+        'subtickets', 'last_child_comment', default='false',
+        doc=_("""If `True`, a comment is added to a ticket, and its
+        subscribers notified, when its last open child is closed.
+        """))
+
+    opt_notification_queue = BoolOption(
+        'subtickets', 'notification_queue', default='false',
+        doc=_("""If `True`, the notifications about subtickets added to or
+        removed from a parent are not sent while the ticket is saved, but
+        stored in a queue which is sent by `trac-admin $ENV subtickets
+        notify`, e.g. from a cron job.
+        """))
+
+    opt_notification_max_attempts = IntOption(
+        'subtickets', 'notification_max_attempts', default=5,
+        doc=_("""Number of times a queued notification is tried before it
+        is dropped.
+        """))
+
+    opt_instrumentation = BoolOption(
+        'subtickets', 'instrumentation', default='false',
+        doc=_("""If `True`, the time, the number of SQL statements and the
+        number of tickets of each call of the plugin's hooks are recorded.
+        The totals of each process are shown by `/subtickets/stats` to
+        users having the `SUBTICKETS_STATS` permission.
+        """))
+
+    opt_instrumentation_threshold = FloatOption(
+        'subtickets', 'instrumentation_log_threshold', default=1.0,
+        doc=_("""Calls of the plugin's hooks lasting longer than this number
+        of seconds are logged as warnings, when `instrumentation` is
+        enabled.
+        """))
+
     def __init__(self):
         self._version = None
+        self._recursive_cte = None
+        self._closure_valid = None
+        self._coalescing = threading.local()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
         self.ui = None
         # bind the 'traccsubtickets' catalog to the locale directory
         try:
@@ -112,45 +321,26 @@ class SubTicketsSystem(Component):
         return False
 
     def upgrade_environment(self, db=None):
-        db_manager = DatabaseManager(self.env).get_connector()[0]
-
-        # update the version
         with self.env.db_transaction as db:
-            old_data = {}  # {table.name: (cols, rows)}
             cursor = db.cursor()
             if not self.found_db_version:
+                upgrades.create_tables(self.env, cursor, db_default.tables)
                 cursor.execute("""
                     INSERT INTO {0} (name, value) VALUES (%s, %s)
                     """.format(db.quote('system')), (db_default.name, db_default.version))
             else:
+                # run the upgrade steps from the found version onwards
+                for version in range(self.found_db_version + 1,
+                                     db_default.version + 1):
+                    name = 'tracsubtickets.upgrades.db%i' % version
+                    script = importlib.import_module(name)
+                    self.log.info("Upgrading subtickets schema to "
+                                  "version %d", version)
+                    script.do_upgrade(self.env, version, cursor)
                 cursor.execute("""
                     UPDATE {0} SET value=%s WHERE name=%s
                     """.format(db.quote('system')), (db_default.version, db_default.name))
 
-                for table in db_default.tables:
-                    cursor.execute("""
-                        SELECT * FROM """ + table.name)
-                    cols = [x[0] for x in cursor.description]
-                    rows = cursor.fetchall()
-                    old_data[table.name] = (cols, rows)
-                    cursor.execute("""
-                        DROP TABLE """ + table.name)
-
-            # insert the default table
-            for table in db_default.tables:
-                for sql in db_manager.to_sql(table):
-                    cursor.execute(sql)
-
-                # add old data
-                if table.name in old_data:
-                    cols, rows = old_data[table.name]
-                    sql = """
-                        INSERT INTO %s (%s) VALUES (%s)
-                        """ % (table.name, ','.join(cols),
-                               ','.join(['%s'] * len(cols)))
-                    for row in rows:
-                        cursor.execute(sql, row)
-
             # add the custom field
             cfield = self.config['ticket-custom']
             if 'parents' not in cfield:
@@ -163,110 +353,229 @@ class SubTicketsSystem(Component):
     def ticket_created(self, ticket):
         self.ticket_changed(ticket, '', ticket['reporter'], {'parents': ''})
 
+    @instrumented(nodes=lambda ticket, *args: 1)
     def ticket_changed(self, ticket, comment, author, old_values):
-        if 'parents' not in old_values:
-            return
+        if self.opt_rollup and (ticket['parents'] or
+                                old_values.get('parents')):
+            fields = ['status', 'parents'] + list(self.opt_rollup_fields)
+            if any(field in old_values for field in fields):
+                # the rollups of the ancestors may have changed
+                del self._rollup_cache
 
-        old_parents = old_values.get('parents', '') or ''
+        old_parents = old_values.get('parents', ticket['parents']) or ''
         old_parents = set(NUMBERS_RE.findall(old_parents))
         new_parents = set(NUMBERS_RE.findall(ticket['parents'] or ''))
+        was_open = old_values.get('status', ticket['status']) != 'closed'
+        is_open = ticket['status'] != 'closed'
 
-        if new_parents == old_parents:
+        if new_parents == old_parents and was_open == is_open:
             return
 
+        changes = OrderedDict()  # {(parent, author): (added, removed)}
         with self.env.db_transaction as db:
+            self._update_counts(db, old_parents, new_parents, was_open,
+                                is_open, author)
+            if new_parents == old_parents:
+                return
+
             # remove old parents
             for parent in old_parents - new_parents:
                 db("""
                     DELETE FROM subtickets WHERE parent=%s AND child=%s
                     """, (parent, ticket.id))
-                # add a comment to old parent
-                xticket = Ticket(self.env, parent)
-                xticket.save_changes(
-                    author,
-                    _('Remove a subticket #%(id)s (%(summary)s).',
-                      id=ticket.id, summary=ticket['summary']))
-                self.send_notification(xticket, author)
+                changes[(int(parent), author)] = \
+                    ([], [(ticket.id, ticket['summary'])])
 
             # add new parents
             for parent in new_parents - old_parents:
                 db("""
                     INSERT INTO subtickets VALUES(%s, %s)
                     """, (parent, ticket.id))
-                # add a comment to new parent
-                xticket = Ticket(self.env, parent)
-                xticket.save_changes(author, _('Add a subticket #%s (%s).') % (
-                    ticket.id, ticket['summary']))
-                self.send_notification(xticket, author)
+                changes[(int(parent), author)] = \
+                    ([(ticket.id, ticket['summary'])], [])
+
+            self._relations_changed(db, old_parents ^ new_parents,
+                                    ticket.id)
 
+            # add a comment to the old and new parents
+            state = self._coalescing
+            if getattr(state, 'depth', 0):
+                for key, (added, removed) in changes.items():
+                    pending = state.changes.setdefault(key, ([], []))
+                    pending[0].extend(added)
+                    pending[1].extend(removed)
+            else:
+                self._save_parent_changes(changes)
+
+    @instrumented(nodes=lambda ticket: 1)
     def ticket_deleted(self, ticket):
         with self.env.db_transaction as db:
+            parents = [parent for parent, in db("""
+                SELECT parent FROM subtickets WHERE child=%s
+                """, (ticket.id, ))]
+            self._update_counts(db, parents, (),
+                                ticket['status'] != 'closed', False)
             cursor = db.cursor()
             # TODO: check if there's any child ticket
             cursor.execute("""
                 DELETE FROM subtickets WHERE child=%s
                 """, (ticket.id, ))
+            self._relations_changed(db, parents, ticket.id)
+
+    def _update_counts(self, db, old_parents, new_parents, was_open,
+                       is_open, author=None):
+        """Update the numbers of open and of all children of the parents
+        of a ticket after its parents or its status changed.
+        """
+        old_parents = set(int(parent) for parent in old_parents)
+        new_parents = set(int(parent) for parent in new_parents)
+        deltas = {}
+        for parent in old_parents | new_parents:
+            total = (parent in new_parents) - (parent in old_parents)
+            open_ = (parent in new_parents and is_open) - \
+                    (parent in old_parents and was_open)
+            if total or open_:
+                deltas[parent] = (open_, total)
+        if not deltas:
+            return
+        existing = set()
+        for chunk in _chunks(sorted(deltas)):
+            existing.update(parent for parent, in db("""
+                SELECT parent FROM subtickets_counts WHERE parent IN ({0})
+                """.format(','.join(['%s'] * len(chunk))), chunk))
+        updated = [(open_, total, parent)
+                   for parent, (open_, total) in sorted(deltas.items())
+                   if parent in existing]
+        inserted = [(parent, open_, total)
+                    for parent, (open_, total) in sorted(deltas.items())
+                    if parent not in existing]
+        if updated:
+            db.executemany("""
+                UPDATE subtickets_counts
+                SET open_children=open_children+%s,
+                    total_children=total_children+%s
+                WHERE parent=%s
+                """, updated)
+        if inserted:
+            db.executemany("""
+                INSERT INTO subtickets_counts
+                    (parent, open_children, total_children)
+                VALUES (%s, %s, %s)
+                """, inserted)
+
+        closing = sorted(parent for parent, (open_, total) in deltas.items()
+                         if open_ < 0)
+        if self.opt_last_child_comment and closing and author is not None:
+            for parent, (open_, total) in self.get_counts(closing).items():
+                if not open_ and total:
+                    xticket = Ticket(self.env, parent)
+                    xticket.save_changes(author,
+                                         _("All subtickets are closed."))
+                    self._notify(db, xticket, author)
+
+    def get_counts(self, ids):
+        """Return the numbers of open and of all children of the tickets
+        among `ids` having any, as a `{id: (open, total)}` dictionary.
+        """
+        counts = {}
+        with self.env.db_query as db:
+            for chunk in _chunks(sorted(set(int(id) for id in ids))):
+                for parent, open_, total in db("""
+                        SELECT parent, open_children, total_children
+                        FROM subtickets_counts WHERE parent IN ({0})
+                        """.format(','.join(['%s'] * len(chunk))), chunk):
+                    if total:
+                        counts[parent] = (open_, total)
+        return counts
+
+    def rebuild_counts(self):
+        """Fill the `subtickets_counts` table from the `subtickets` table
+        and the status of the children.
+        """
+        with self.env.db_transaction as db:
+            db("DELETE FROM subtickets_counts")
+            db("""
+                INSERT INTO subtickets_counts
+                    (parent, open_children, total_children)
+                SELECT s.parent,
+                       SUM(CASE WHEN COALESCE(t.status, '')!='closed'
+                                THEN 1 ELSE 0 END),
+                       COUNT(*)
+                FROM subtickets s INNER JOIN ticket t ON t.id=s.child
+                GROUP BY s.parent
+                """)
 
     # ITicketManipulator methods
 
     def prepare_ticket(self, req, ticket, fields, actions):
         pass
 
+    @instrumented(nodes=lambda req, ticket:
+                  len(NUMBERS_RE.findall(ticket['parents'] or '')))
     def validate_ticket(self, req, ticket):
         try:
             invalid_ids = set()
             _ids = set(NUMBERS_RE.findall(ticket['parents'] or ''))
             myid = str(ticket.id)
+            # existence and status of all referenced tickets at once
+            parents = self.get_ticket_values(
+                [id for id in _ids if 0 < int(id) <= 1 << 31], ['status'])
             for id in _ids:
                 if id == myid:
                     invalid_ids.add(id)
                     yield 'parents', _("A ticket cannot be a parent of itself")
-                else:
-                    # check if the id exists
-                    tkt_id = self.env.db_query("""
-                        SELECT id FROM ticket WHERE id=%s
-                        """, (id, ))
-                    if not tkt_id:
-                        invalid_ids.add(id)
-                        yield 'parents', _("Ticket #%(id)s does not exist",
-                                           id=id)
+                elif int(id) not in parents:
+                    invalid_ids.add(id)
+                    yield 'parents', _("Ticket #%(id)s does not exist",
+                                       id=id)
 
-            # circularity check function
+            # load the ancestors of all new parents at once
+            ancestors = self.get_edges([x for x in _ids
+                                        if x not in invalid_ids],
+                                       ancestors=True)
+            done = set()
+
+            # circularity check function, walking each ancestor only once
             def _check_parents(id, all_parents):
-                all_parents = all_parents + [id]
+                if id in done:
+                    return []
+                path = all_parents + [id]
+                on_path = set(path)
                 errors = []
-                parents = self.env.db_query("""
-                    SELECT parent FROM subtickets WHERE child=%s
-                    """, (id, ))
-                for x in [int(x[0]) for x in parents]:
-                    if x in all_parents:
-                        invalid_ids.add(x)
-                        error = ' > '.join(
-                            '#%s' % n for n in all_parents + [x])
-                        errors.append(('parents', _('Circularity error: %(e)s',
-                                                    e=error)))
+                stack = [iter(ancestors.get(id, ()))]
+                while stack:
+                    for x in stack[-1]:
+                        if x in on_path:
+                            error = ' > '.join('#%s' % n for n in path + [x])
+                            errors.append(('parents',
+                                           _('Circularity error: %(e)s',
+                                             e=error)))
+                        elif x not in done:
+                            path.append(x)
+                            on_path.add(x)
+                            stack.append(iter(ancestors.get(x, ())))
+                            break
                     else:
-                        errors += _check_parents(x, all_parents)
+                        stack.pop()
+                        x = path.pop()
+                        on_path.discard(x)
+                        done.add(x)
                 return errors
 
             for x in [i for i in _ids if i not in invalid_ids]:
                 # Refuse modification if parent closed
                 # or if parentship is to be made circular
-                try:
-                    parent = Ticket(self.env, x)
-                    if parent and parent['status'] == 'closed' \
-                       and self.opt_no_modif_w_p_c:
-                        invalid_ids.add(x)
-                        yield None, _("""Cannot modify ticket because
+                if parents[int(x)]['status'] == 'closed' \
+                   and self.opt_no_modif_w_p_c:
+                    invalid_ids.add(x)
+                    yield None, _("""Cannot modify ticket because
                             parent ticket #%(id)s is closed.
                             Comments allowed, though.""",
-                                      id=x)
-                    # check circularity
-                    all_parents = ticket.id and [ticket.id] or []
-                    for error in _check_parents(int(x), all_parents):
-                        yield error
-                except ResourceNotFound:
-                    invalid_ids.add(x)
+                                  id=x)
+                # check circularity
+                all_parents = ticket.id and [ticket.id] or []
+                for error in _check_parents(int(x), all_parents):
+                    yield error
 
             valid_ids = _ids.difference(invalid_ids)
             ticket['parents'] = valid_ids and ', '.join(
@@ -276,16 +585,1247 @@ class SubTicketsSystem(Component):
             self.log.error(traceback.format_exc())
             yield 'parents', _('Not a valid list of ticket IDs.')
 
+    # Coalescing of parent changes
+
+    @contextmanager
+    def coalesce_changes(self):
+        """Collect the comments about subtickets added to or removed from
+        their parents until the end of the `with` block, then save one
+        comment and send one notification per parent.
+
+        The relations themselves are still updated immediately. The
+        collected comments are dropped if the block raises an exception.
+        """
+        self.begin_coalescing()
+        try:
+            yield
+        except BaseException:
+            self.end_coalescing(discard=True)
+            raise
+        else:
+            self.end_coalescing()
+
+    def begin_coalescing(self):
+        state = self._coalescing
+        state.depth = getattr(state, 'depth', 0) + 1
+        if state.depth == 1:
+            state.changes = OrderedDict()
+
+    def end_coalescing(self, discard=False):
+        state = self._coalescing
+        if not getattr(state, 'depth', 0):
+            return
+        state.depth -= 1
+        if state.depth:
+            return
+        changes, state.changes = state.changes, None
+        if changes and not discard:
+            self._save_parent_changes(changes)
+
+    def _save_parent_changes(self, changes):
+        with self.env.db_transaction as db:
+            for (parent, author), (added, removed) in changes.items():
+                xticket = Ticket(self.env, parent)
+                xticket.save_changes(author,
+                                     self._format_comment(added, removed))
+                self._notify(db, xticket, author)
+
+    def _format_comment(self, added, removed):
+        if len(added) + len(removed) == 1:
+            if removed:
+                id, summary = removed[0]
+                return _('Remove a subticket #%(id)s (%(summary)s).',
+                         id=id, summary=summary)
+            return _('Add a subticket #%s (%s).') % added[0]
+        comment = []
+        if added:
+            comment.append(_('Add subtickets %(ids)s.',
+                             ids=_format_ids(added)))
+        if removed:
+            comment.append(_('Remove subtickets %(ids)s.',
+                             ids=_format_ids(removed)))
+        return '\n\n'.join(comment)
+
+    # Hierarchy queries
+
+    def get_edges(self, ids, ancestors=False, max_depth=-1):
+        """Return the relations reachable from `ids` as a
+        `{node: [neighbour, ...]}` dictionary.
+
+        Neighbours are children, or parents if `ancestors` is `True`.
+        `max_depth` limits the walk like the `recursion_depth` option:
+        `-1` is unlimited, `0` stops at the immediate neighbours of `ids`.
+        """
+        ids = set(int(id) for id in ids if id is not None)
+        if not ids:
+            return {}
+        if self._closure_enabled():
+            return self._get_edges_closure(ids, ancestors, max_depth)
+        if self._supports_recursive_cte():
+            return self._get_edges_cte(ids, ancestors, max_depth)
+        return self._get_edges_by_level(ids, ancestors, max_depth)
+
+    @instrumented(result_nodes=lambda tree: _count_nodes(tree))
+    def get_tree(self, id, max_depth=-1):
+        """Return the descendants of ticket `id` as nested dictionaries
+        `{child: {grandchild: {...}}}`.
+
+        Children beyond `max_depth` are mapped to `None`. The tree is
+        built iteratively in pre-order, children sorted by id, and each
+        ticket is expanded only at its first occurrence: the subtree of a
+        ticket having several parents, or a relation leading back into
+        the current branch, is mapped to `None` when met again, so that
+        the tree grows with the number of tickets, not of paths. The
+        relations are taken from the subtree cache when possible.
+        """
+        cache = self._subtree_cache
+        key = (id, max_depth)
+        edges = cache.get(key)
+        if edges is None:
+            edges = self.get_edges([id], max_depth=max_depth)
+            cache.set(key, edges)
+        return _build_tree(id, edges, max_depth)[0]
+
+    @instrumented(result_nodes=lambda result: _count_nodes(result[0]))
+    def get_tree_page(self, id, max_depth=-1, limit=None):
+        """Return the first `limit` descendants of ticket `id`, in the
+        pre-order of `get_tree`, as a `(tree, counts)` tuple where
+        `counts` maps `id` and each ticket expanded in `tree` to its
+        number of children.
+
+        The relations are loaded like `get_edges` does, reading at most
+        `PAGE_EDGES_FACTOR` times `limit` of them. A larger subtree is
+        loaded level by level instead, and only for the tickets among
+        the first `limit` ones, so that the work is bounded by `limit`
+        rather than by the size of the hierarchy. All descendants are
+        returned if `limit` is `None`.
+        """
+        cache = self._subtree_cache
+        key = (id, max_depth, limit)
+        edges = cache.get(key)
+        if edges is None:
+            if limit is None:
+                edges = self.get_edges([id], max_depth=max_depth)
+            else:
+                edges = self._get_edges_page(id, max_depth, limit)
+            cache.set(key, edges)
+        tree, expanded = _build_tree(id, edges, max_depth, limit)
+        counts = dict((node, len(edges.get(node, ()))) for node in expanded)
+        return tree, counts
+
+    def get_ticket_values(self, ids, fields=('summary', 'status', 'type')):
+        """Return the values of `fields` for the existing tickets among
+        `ids`, as a `{id: {field: value}}` dictionary.
+
+        Values are fetched for all tickets at once, with one query per
+        chunk of ids for the `ticket` table and one for `ticket_custom`,
+        and are converted like `Ticket` does.
+        """
+        ids = sorted(set(int(id) for id in ids if id is not None))
+        fields = set(fields)
+        std_fields, custom_fields, time_fields = [], {}, set()
+        for field in TicketSystem(self.env).get_ticket_fields():
+            name = field['name']
+            if name not in fields:
+                continue
+            if field.get('custom'):
+                custom_fields[name] = field
+            else:
+                std_fields.append(name)
+            if field.get('type') == 'time':
+                time_fields.add(name)
+        for name in ('time', 'changetime'):
+            if name in fields and name not in std_fields:
+                std_fields.append(name)
+                time_fields.add(name)
+
+        tickets = {}
+        with self.env.db_query as db:
+            for chunk in _chunks(ids):
+                in_ = ','.join(['%s'] * len(chunk))
+                for row in db("""
+                        SELECT {0} FROM ticket WHERE id IN ({1})
+                        """.format(','.join(['id'] + std_fields), in_),
+                        chunk):
+                    values = {}
+                    for name, value in zip(std_fields, row[1:]):
+                        if name in time_fields:
+                            value = from_utimestamp(value)
+                        elif value is None:
+                            value = empty
+                        values[name] = value
+                    tickets[row[0]] = values
+                if not custom_fields or not tickets:
+                    continue
+                names = sorted(custom_fields)
+                for id, name, value in db("""
+                        SELECT ticket, name, value FROM ticket_custom
+                        WHERE ticket IN ({0}) AND name IN ({1})
+                        """.format(in_, ','.join(['%s'] * len(names))),
+                        chunk + names):
+                    if id not in tickets:
+                        continue
+                    if name in time_fields and value:
+                        try:
+                            value = from_utimestamp(int(value))
+                        except ValueError:
+                            value = None
+                    elif value is None:
+                        value = empty
+                    tickets[id][name] = value
+
+        # fill in the defaults of custom fields without a stored value
+        for name, field in custom_fields.items():
+            default = field.get('value')
+            options = field.get('options')
+            if default and options and default not in options:
+                try:
+                    default = options[int(default)]
+                except (ValueError, IndexError):
+                    pass
+            if default and name not in time_fields:
+                for values in tickets.values():
+                    values.setdefault(name, default)
+        return tickets
+
+    def count_children(self, ids):
+        """Return the number of children of each of `ids` having any, as
+        a `{id: count}` dictionary.
+        """
+        counts = {}
+        with self.env.db_query as db:
+            for chunk in _chunks(sorted(set(int(id) for id in ids))):
+                for parent, count in db("""
+                        SELECT parent, COUNT(*) FROM subtickets
+                        WHERE parent IN ({0}) GROUP BY parent
+                        """.format(','.join(['%s'] * len(chunk))), chunk):
+                    counts[parent] = count
+        return counts
+
+    def get_relations(self, ids):
+        """Return the parents and children of each of `ids`, as a
+        `{id: (parents, children)}` dictionary of sorted lists.
+
+        The relations are fetched with one query per chunk of ids.
+        """
+        ids = sorted(set(int(id) for id in ids))
+        relations = dict((id, ([], [])) for id in ids)
+        with self.env.db_query as db:
+            for chunk in _chunks(ids, IN_CLAUSE_SIZE // 2):
+                in_ = ','.join(['%s'] * len(chunk))
+                for parent, child in db("""
+                        SELECT parent, child FROM subtickets
+                        WHERE parent IN ({0}) OR child IN ({0})
+                        ORDER BY parent, child
+                        """.format(in_), chunk + chunk):
+                    if parent in relations:
+                        relations[parent][1].append(child)
+                    if child in relations:
+                        relations[child][0].append(parent)
+        # a relation may be in two chunks
+        return dict((id, (sorted(set(parents)), sorted(set(children))))
+                    for id, (parents, children) in relations.items())
+
+    def get_child_ids(self, id, offset=0, limit=None):
+        """Return the sorted ids of the children of ticket `id`, skipping
+        the first `offset` ones and returning at most `limit` of them.
+        """
+        if limit is None:
+            rows = self.env.db_query("""
+                SELECT child FROM subtickets WHERE parent=%s ORDER BY child
+                """, (id,))[offset:]
+        else:
+            rows = self.env.db_query("""
+                SELECT child FROM subtickets WHERE parent=%s ORDER BY child
+                LIMIT %s OFFSET %s
+                """, (id, limit, offset))
+        return [child for child, in rows]
+
+    def get_last_change(self, ids):
+        """Return the latest `changetime` of the tickets among `ids`, as a
+        timestamp in microseconds, or `None` if none of them exists.
+        """
+        last = None
+        with self.env.db_query as db:
+            for chunk in _chunks(sorted(set(int(id) for id in ids))):
+                for changetime, in db("""
+                        SELECT MAX(changetime) FROM ticket WHERE id IN ({0})
+                        """.format(','.join(['%s'] * len(chunk))), chunk):
+                    if changetime is not None:
+                        last = max(last, changetime) \
+                               if last is not None else changetime
+        return last
+
+    def get_rollup(self, id, fields=()):
+        """Return the number of descendants of ticket `id` per status, as
+        a `{status: count}` dictionary, and the sums of the numeric values
+        of the custom `fields` over them, as a `{field: sum}` dictionary.
+
+        Both are aggregated by the database over all descendants at once,
+        and cached until a descendant or a relation changes.
+        """
+        key = (int(id), tuple(fields))
+        cache = self._rollup_cache
+        rollup = cache.get(key)
+        if rollup is not None:
+            return rollup
+        statuses = {}
+        for status, count in self._query_descendants(id, """
+                SELECT status, COUNT(*) FROM ticket
+                WHERE id IN ({ids}) GROUP BY status
+                """):
+            status = status or ''
+            statuses[status] = statuses.get(status, 0) + count
+        sums = dict((field, 0) for field in fields)
+        if fields:
+            # values are summed here, since they are stored as text
+            for name, value, count in self._query_descendants(id, """
+                    SELECT name, value, COUNT(*) FROM ticket_custom
+                    WHERE ticket IN ({ids}) AND name IN ({names})
+                    GROUP BY name, value
+                    """.replace('{names}', ','.join(['%s'] * len(fields))),
+                    list(fields)):
+                try:
+                    sums[name] += float(value) * count
+                except (TypeError, ValueError):
+                    pass
+        rollup = (statuses, sums)
+        cache.set(key, rollup)
+        return rollup
+
+    def _query_descendants(self, id, sql, args=()):
+        """Execute `sql` where `{ids}` stands for the ids of the
+        descendants of ticket `id`, followed by the parameters `args`,
+        and return the rows.
+        """
+        args = list(args)
+        related = self._related_ids_sql(id)
+        with self.env.db_query as db:
+            if related is not None:
+                prefix, prefix_args, ids_sql, ids_args = related
+                # a WITH statement has to go through a cursor, since
+                # read-only connections only accept SELECT statements
+                cursor = db.cursor()
+                cursor.execute(prefix + sql.format(ids=ids_sql),
+                               prefix_args + ids_args + args)
+                return cursor.fetchall()
+            edges = self.get_edges([id])
+            ids = set(x for children in edges.values() for x in children)
+            rows = []
+            for chunk in _chunks(sorted(ids)):
+                rows.extend(db(sql.format(ids=','.join(['%s'] * len(chunk))),
+                               chunk + args))
+            return rows
+
+    def _related_ids_sql(self, id, ancestors=False, max_depth=-1):
+        """Return a subquery selecting the ids of the descendants of
+        ticket `id`, or of its ancestors if `ancestors` is `True`, limited
+        by `max_depth` like in `get_edges`.
+
+        The result is a `(prefix, prefix_args, sql, args)` tuple, where
+        `prefix` is a `WITH` clause to put in front of the statement using
+        the subquery `sql`, or `None` if the database supports neither the
+        closure table nor recursive queries.
+        """
+        id = int(id)
+        if self._closure_enabled():
+            near, far = ('descendant', 'ancestor') if ancestors \
+                        else ('ancestor', 'descendant')
+            sql = """
+                SELECT {far} FROM subtickets_closure WHERE {near}=%s
+                """.format(near=near, far=far)
+            args = [id]
+            if max_depth != -1:
+                sql += " AND depth<=%s"
+                args.append(max_depth + 1)
+            return '', [], sql, args
+        if not self._supports_recursive_cte():
+            return None
+        src, dst = ('child', 'parent') if ancestors else ('parent', 'child')
+        if max_depth == -1:
+            prefix = """
+                WITH RECURSIVE related(id) AS (
+                    SELECT {dst} FROM subtickets WHERE {src}=%s
+                  UNION
+                    SELECT s.{dst} FROM subtickets s
+                    INNER JOIN related r ON s.{src}=r.id
+                )
+                """
+            prefix_args = [id]
+        else:
+            prefix = """
+                WITH RECURSIVE related(id, depth) AS (
+                    SELECT {dst}, 0 FROM subtickets WHERE {src}=%s
+                  UNION
+                    SELECT s.{dst}, r.depth + 1 FROM subtickets s
+                    INNER JOIN related r ON s.{src}=r.id
+                    WHERE r.depth < %s
+                )
+                """
+            prefix_args = [id, max_depth]
+        return (prefix.format(src=src, dst=dst), prefix_args,
+                "SELECT id FROM related", [])
+
+    def query_tickets(self, id, fields, ancestors=False, max_depth=-1,
+                      constraints=None, order='id', desc=False, offset=0,
+                      limit=None):
+        """Generate the `(id, value, ...)` rows of the values of `fields`
+        for the descendants of ticket `id`, or for its ancestors if
+        `ancestors` is `True`, limited by `max_depth` like in `get_edges`.
+
+        `constraints` maps field names to `(negate, values)` tuples: the
+        value of the field has to be one of `values`, or none of them if
+        `negate` is `True`. The tickets are selected, filtered, sorted by
+        `order` and paginated by the database. They are read
+        `EXPORT_BATCH_SIZE` at a time, each statement resuming after the
+        `order` value and id of the last ticket read by the previous one,
+        so that the memory used does not depend on the number of tickets.
+        """
+        after = None
+        while limit is None or limit > 0:
+            size = EXPORT_BATCH_SIZE if limit is None \
+                   else min(limit, EXPORT_BATCH_SIZE)
+            prefix, sql, args, time_fields = self._ticket_query_sql(
+                id, fields, ancestors, max_depth, constraints,
+                order or 'id', desc, after)
+            if sql is None:
+                return
+            with self.env.db_query as db:
+                cursor = db.cursor()
+                cursor.execute(prefix + sql + " LIMIT %s OFFSET %s",
+                               args + [size, offset if after is None else 0])
+                rows = cursor.fetchall()
+            for row in rows:
+                yield (row[0],) + _convert_values(fields, row[2:],
+                                                  time_fields)
+            if len(rows) < size:
+                break
+            if limit is not None:
+                limit -= len(rows)
+            after = rows[-1][1], rows[-1][0]
+
+    def count_tickets(self, id, ancestors=False, max_depth=-1,
+                      constraints=None):
+        """Return the number of tickets selected by `query_tickets` with
+        the same arguments.
+        """
+        prefix, sql, args, time_fields = self._ticket_query_sql(
+            id, (), ancestors, max_depth, constraints, None, False)
+        if sql is None:
+            return 0
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute(prefix + "SELECT COUNT(*) FROM ({0}) x"
+                                    .format(sql), args)
+            return cursor.fetchone()[0]
+
+    def _ticket_query_sql(self, id, fields, ancestors, max_depth,
+                          constraints, order, desc, after=None):
+        """Return the `WITH` clause, statement and parameters of
+        `query_tickets`, and the names of its time fields.
+
+        If `order` is given, the statement selects the value it sorts on
+        after the id, and only the tickets following the `(value, id)`
+        of `after` if given.
+        """
+        ticket_fields, time_fields = self._get_query_fields()
+        fields = [name for name in fields if name in ticket_fields]
+        constraints = dict((name, value)
+                           for name, value in (constraints or {}).items()
+                           if name in ticket_fields and name != 'id')
+        if order is not None and order not in ticket_fields:
+            order = 'id'
+
+        joins, join_args = [], []
+        columns = {'id': 't.id'}
+
+        def column(name):
+            if name not in columns:
+                columns[name] = _field_column(ticket_fields, name, 't',
+                                              't.id', joins, join_args)
+            return columns[name]
+
+        select = ['t.id'] + [column(name) for name in fields]
+        where, where_args = [], []
+        for name in sorted(constraints):
+            negate, values = constraints[name]
+            if name in time_fields or not values:
+                continue
+            where.append("COALESCE({0}, '') {1}IN ({2})".format(
+                column(name), 'NOT ' if negate else '',
+                ','.join(['%s'] * len(values))))
+            where_args.extend(values)
+        order_by = ''
+        if order is not None:
+            expr = column(order)
+            # the value sorted on is never NULL, to resume after it
+            if ticket_fields[order].get('custom') or \
+                    order != 'id' and order not in time_fields:
+                expr = "COALESCE({0}, '')".format(expr)
+            select.insert(1, expr)
+            direction = ' DESC' if desc else ''
+            order_by = " ORDER BY {0}{1}, t.id{1}".format(expr, direction)
+            if after is not None:
+                where.append("({0}{1}%s OR {0}=%s AND t.id{1}%s)".format(
+                    expr, '<' if desc else '>'))
+                where_args.extend([after[0], after[0], after[1]])
+
+        related = self._related_ids(id, ancestors, max_depth)
+        if related is None:
+            return '', None, [], time_fields
+        prefix, prefix_args, ids_sql, ids_args = related
+        sql = """
+            SELECT {0} FROM ticket t {1}
+            WHERE t.id IN ({2}){3}{4}
+            """.format(', '.join(select), ' '.join(joins), ids_sql,
+                       ''.join(' AND ' + w for w in where), order_by)
+        args = prefix_args + join_args + ids_args + where_args
+        return prefix, sql, args, time_fields
+
+    def export_relations(self, root=None, fields=()):
+        """Generate the `(parent, child, parent_values, child_values)`
+        tuples of all relations, or of those below ticket `root`, sorted
+        by parent and child, where the values are the tuples of the values
+        of `fields` of both tickets.
+
+        The relations are read `EXPORT_BATCH_SIZE` at a time, each
+        statement resuming after the last relation read by the previous
+        one, so that the memory used does not depend on the number of
+        relations, whatever the database backend and its cursors. Below
+        `root`, the statements are limited to a batch of parents at a time,
+        taken from `_get_subtree_batches`.
+        """
+        ticket_fields, time_fields = self._get_query_fields()
+        fields = [name for name in fields
+                  if name in ticket_fields and name != 'id']
+        joins, join_args = [], []
+        select = ['s.parent', 's.child']
+        for table, id_expr in (('p', 's.parent'), ('c', 's.child')):
+            select.extend(_field_column(ticket_fields, name, table, id_expr,
+                                        joins, join_args)
+                          for name in fields)
+        sql = """
+            SELECT {0} FROM subtickets s
+            LEFT OUTER JOIN ticket p ON p.id=s.parent
+            LEFT OUTER JOIN ticket c ON c.id=s.child {1}
+            WHERE (s.parent>%s OR s.parent=%s AND s.child>%s){{0}}
+            ORDER BY s.parent, s.child LIMIT %s
+            """.format(', '.join(select), ' '.join(joins))
+        if root is None:
+            batches = [None]
+        else:
+            batches = self._get_subtree_batches(root)
+        for parents in batches:
+            where = ''
+            if parents is not None:
+                where = " AND s.parent IN ({0})" \
+                        .format(','.join(['%s'] * len(parents)))
+            last = (0, 0)
+            while True:
+                rows = self.env.db_query(
+                    sql.format(where), join_args +
+                    [last[0], last[0], last[1]] + (parents or []) +
+                    [EXPORT_BATCH_SIZE])
+                for row in rows:
+                    size = len(fields)
+                    yield (row[0], row[1],
+                           _convert_values(fields, row[2:2 + size],
+                                           time_fields),
+                           _convert_values(fields, row[2 + size:],
+                                           time_fields))
+                if len(rows) < EXPORT_BATCH_SIZE:
+                    break
+                last = rows[-1][:2]
+
+    def _get_subtree_batches(self, root):
+        """Generate the sorted ids of ticket `root` and of its descendants,
+        in sorted lists of about `IN_CLAUSE_SIZE` ids.
+
+        With the closure table, each list is read by a statement resuming
+        after the last id of the previous one. Otherwise, the ids of the
+        descendants are selected at once, since a recursive query would
+        walk the whole subtree again for each list.
+        """
+        root = int(root)
+        if not self._closure_enabled():
+            related = self._related_ids_sql(root)
+            if related is not None:
+                prefix, prefix_args, ids_sql, ids_args = related
+                with self.env.db_query as db:
+                    cursor = db.cursor()
+                    cursor.execute(prefix + ids_sql, prefix_args + ids_args)
+                    ids = set(row[0] for row in cursor)
+            else:
+                edges = self.get_edges([root])
+                ids = set(x for nodes in edges.values() for x in nodes)
+            ids.add(root)
+            for chunk in _chunks(sorted(ids), IN_CLAUSE_SIZE):
+                yield chunk
+            return
+        last, pending = 0, True
+        while True:
+            rows = self.env.db_query("""
+                SELECT descendant FROM subtickets_closure
+                WHERE ancestor=%s AND descendant>%s
+                ORDER BY descendant LIMIT %s
+                """, (root, last, IN_CLAUSE_SIZE))
+            ids = [row[0] for row in rows]
+            if pending and (len(ids) < IN_CLAUSE_SIZE or root < ids[-1]):
+                ids = sorted(set(ids) | set([root]))
+                pending = False
+            if ids:
+                yield ids
+            if len(rows) < IN_CLAUSE_SIZE:
+                break
+            last = rows[-1][0]
+
+    def get_field_names(self):
+        """Return the names of the ticket fields which `query_tickets`
+        and `export_relations` can return.
+        """
+        return sorted(name for name in self._get_query_fields()[0]
+                      if name != 'id')
+
+    def _get_query_fields(self):
+        """Return the ticket fields as a `{name: field}` dictionary,
+        including `id`, `time` and `changetime`, and the set of the names
+        of the time fields.
+        """
+        ticket_fields = dict((f['name'], f) for f in
+                             TicketSystem(self.env).get_ticket_fields())
+        for name in ('id', 'time', 'changetime'):
+            ticket_fields.setdefault(name, {'name': name, 'type': 'time'
+                                            if name != 'id' else 'text'})
+        time_fields = set(name for name, f in ticket_fields.items()
+                          if f.get('type') == 'time')
+        return ticket_fields, time_fields
+
+    def _related_ids(self, id, ancestors=False, max_depth=-1):
+        """Return the subquery of `_related_ids_sql`, or the inlined ids
+        walked by `get_edges` if the database cannot select them, or
+        `None` if there are none.
+        """
+        related = self._related_ids_sql(id, ancestors, max_depth)
+        if related is None:
+            edges = self.get_edges([id], ancestors, max_depth)
+            ids = set(x for nodes in edges.values() for x in nodes)
+            if not ids:
+                return None
+            # the ids are integers, hence safe to inline in the statement
+            related = ('', [], ','.join(str(x) for x in sorted(ids)), [])
+        return related
+
+    def get_open_children(self, id, all_levels=False):
+        """Return the sorted ids of the children of ticket `id` which are
+        not closed, or of all its descendants if `all_levels` is `True`.
+        """
+        if not all_levels:
+            open_, total = self.get_counts([id]).get(int(id), (0, 0))
+            if not open_:
+                return []
+            rows = self.env.db_query("""
+                SELECT s.child FROM subtickets s
+                INNER JOIN ticket t ON t.id=s.child
+                WHERE s.parent=%s AND COALESCE(t.status, '')!='closed'
+                """, (id, ))
+        elif self._closure_enabled():
+            rows = self.env.db_query("""
+                SELECT c.descendant FROM subtickets_closure c
+                INNER JOIN ticket t ON t.id=c.descendant
+                WHERE c.ancestor=%s AND COALESCE(t.status, '')!='closed'
+                """, (id, ))
+        else:
+            edges = self.get_edges([id])
+            ids = set(x for children in edges.values() for x in children)
+            return self._filter_by_status(ids, closed=False)
+        return sorted(set(row[0] for row in rows))
+
+    def get_closed_tickets(self, ids, all_levels=False):
+        """Return the sorted ids of the closed tickets among `ids`, or
+        among `ids` and all their ancestors if `all_levels` is `True`.
+        """
+        ids = set(int(id) for id in ids)
+        if all_levels:
+            edges = self.get_edges(ids, ancestors=True)
+            ids.update(x for parents in edges.values() for x in parents)
+        return self._filter_by_status(ids, closed=True)
+
+    def _filter_by_status(self, ids, closed):
+        op = '=' if closed else '!='
+        result = set()
+        with self.env.db_query as db:
+            for chunk in _chunks(sorted(ids)):
+                result.update(id for id, in db("""
+                    SELECT id FROM ticket
+                    WHERE id IN ({0}) AND COALESCE(status, ''){1}'closed'
+                    """.format(','.join(['%s'] * len(chunk)), op), chunk))
+        return sorted(result)
+
+    @cached
+    def _subtree_cache(self):
+        """Relations of the recently loaded subtrees, keyed by
+        `(id, max_depth)`. Deleting the attribute empties the cache in all
+        processes.
+        """
+        return LRUCache(self.opt_tree_cache_size)
+
+    @cached
+    def _rollup_cache(self):
+        """Rollups of the recently shown tickets, keyed by `(id, fields)`.
+        Deleting the attribute empties the cache in all processes.
+        """
+        return LRUCache(self.opt_tree_cache_size)
+
+    def _get_edges_closure(self, ids, ancestors, max_depth, limit=None):
+        if ancestors:
+            src, dst, near, far = 'child', 'parent', 'descendant', 'ancestor'
+        else:
+            src, dst, near, far = 'parent', 'child', 'ancestor', 'descendant'
+        edges = {}
+        with self.env.db_query as db:
+            for chunk in _chunks(sorted(ids)):
+                in_ = ','.join(['%s'] * len(chunk))
+                sql = """
+                    SELECT {src}, {dst} FROM subtickets WHERE {src} IN ({in_})
+                    UNION
+                    SELECT s.{src}, s.{dst} FROM subtickets_closure c
+                    INNER JOIN subtickets s ON s.{src}=c.{far}
+                    WHERE c.{near} IN ({in_})
+                    """
+                args = chunk + chunk
+                if max_depth != -1:
+                    sql += " AND c.depth<=%s"
+                    args.append(max_depth)
+                if limit is not None:
+                    sql += " LIMIT %s"
+                    args.append(limit)
+                for src_id, dst_id in db(sql.format(src=src, dst=dst,
+                                                    near=near, far=far,
+                                                    in_=in_), args):
+                    _add_edge(edges, src_id, dst_id)
+        return edges
+
+    def _get_edges_cte(self, ids, ancestors, max_depth, limit=None):
+        src, dst = ('child', 'parent') if ancestors else ('parent', 'child')
+        edges = {}
+        with self.env.db_query as db:
+            for chunk in _chunks(sorted(ids)):
+                in_ = ','.join(['%s'] * len(chunk))
+                if max_depth == -1:
+                    # UNION discards duplicates, which also ends cycles
+                    sql = """
+                        WITH RECURSIVE tree(src, dst) AS (
+                            SELECT {src}, {dst} FROM subtickets
+                            WHERE {src} IN ({in_})
+                          UNION
+                            SELECT s.{src}, s.{dst} FROM subtickets s
+                            INNER JOIN tree t ON s.{src}=t.dst
+                        )
+                        SELECT src, dst FROM tree
+                        """
+                    args = chunk
+                else:
+                    sql = """
+                        WITH RECURSIVE tree(src, dst, depth) AS (
+                            SELECT {src}, {dst}, 0 FROM subtickets
+                            WHERE {src} IN ({in_})
+                          UNION
+                            SELECT s.{src}, s.{dst}, t.depth + 1
+                            FROM subtickets s
+                            INNER JOIN tree t ON s.{src}=t.dst
+                            WHERE t.depth < %s
+                        )
+                        SELECT DISTINCT src, dst FROM tree
+                        """
+                    args = chunk + [max_depth]
+                if limit is not None:
+                    sql += " LIMIT %s"
+                    args.append(limit)
+                # a WITH statement has to go through a cursor, since
+                # read-only connections only accept SELECT statements
+                cursor = db.cursor()
+                cursor.execute(sql.format(src=src, dst=dst, in_=in_), args)
+                for src_id, dst_id in cursor:
+                    _add_edge(edges, src_id, dst_id)
+        return edges
+
+    def _get_edges_by_level(self, ids, ancestors, max_depth):
+        src, dst = ('child', 'parent') if ancestors else ('parent', 'child')
+        edges = {}
+        visited = set(ids)
+        level = ids
+        depth = 0
+        with self.env.db_query as db:
+            while level:
+                found = set()
+                for chunk in _chunks(sorted(level)):
+                    for src_id, dst_id in db("""
+                            SELECT {src}, {dst} FROM subtickets
+                            WHERE {src} IN ({in_})
+                            """.format(src=src, dst=dst,
+                                       in_=','.join(['%s'] * len(chunk))),
+                            chunk):
+                        _add_edge(edges, src_id, dst_id)
+                        found.add(int(dst_id))
+                if max_depth != -1 and depth >= max_depth:
+                    break
+                level = found - visited
+                visited |= level
+                depth += 1
+        return edges
+
+    def _get_edges_page(self, id, max_depth, limit):
+        """Load the relations needed by the first `limit` descendants of
+        `id`: the whole subtree in one statement if it has at most
+        `PAGE_EDGES_FACTOR` times `limit` relations, else those of the
+        tickets expanded among the first `limit`, one level of the tree
+        at a time. Each ticket loaded by level has an entry, if only an
+        empty list.
+        """
+        cap = limit * PAGE_EDGES_FACTOR
+        edges = None
+        if self._closure_enabled():
+            edges = self._get_edges_closure([id], False, max_depth, cap + 1)
+        elif self._supports_recursive_cte():
+            edges = self._get_edges_cte([id], False, max_depth, cap + 1)
+        if edges is not None and \
+                sum(len(children) for children in edges.values()) <= cap:
+            return edges
+        edges = {}
+        level = [id]
+        with self.env.db_query as db:
+            while level:
+                for chunk in _chunks(sorted(level)):
+                    for parent, child in db("""
+                            SELECT parent, child FROM subtickets
+                            WHERE parent IN ({0})
+                            """.format(','.join(['%s'] * len(chunk))),
+                            chunk):
+                        _add_edge(edges, parent, child)
+                for node in level:
+                    edges.setdefault(node, [])
+                # the children loaded may push later tickets past `limit`
+                level = [node for node in
+                         _build_tree(id, edges, max_depth, limit)[1]
+                         if node not in edges]
+        return edges
+
+    def _supports_recursive_cte(self):
+        if self._recursive_cte is None:
+            uri = DatabaseManager(self.env).connection_uri
+            scheme = uri.split(':', 1)[0]
+            supported = False
+            if scheme == 'sqlite':
+                supported = sqlite3.sqlite_version_info >= (3, 8, 3)
+            elif scheme == 'postgres':
+                supported = True
+            elif scheme == 'mysql':
+                for version, in self.env.db_query("SELECT VERSION()"):
+                    numbers = [int(n) for n in NUMBERS_RE.findall(version)]
+                    if 'mariadb' in version.lower():
+                        supported = numbers[:2] >= [10, 2]
+                    else:
+                        supported = numbers[:1] >= [8]
+            self._recursive_cte = supported
+        return self._recursive_cte
+
+    # Closure table
+
+    def rebuild_closure(self):
+        """Fill the `subtickets_closure` table from the `subtickets`
+        table, one level of descendants per statement.
+        """
+        with self.env.db_transaction as db:
+            db("DELETE FROM subtickets_closure")
+            db("""
+                INSERT INTO subtickets_closure (ancestor, descendant, depth)
+                SELECT parent, child, 1 FROM subtickets
+                """)
+            depth = 1
+            while True:
+                cursor = db.cursor()
+                cursor.execute("""
+                    INSERT INTO subtickets_closure
+                        (ancestor, descendant, depth)
+                    SELECT c.ancestor, s.child, %s
+                    FROM subtickets_closure c
+                    INNER JOIN subtickets s ON s.parent=c.descendant
+                    WHERE c.depth=%s AND NOT EXISTS (
+                        SELECT * FROM subtickets_closure x
+                        WHERE x.ancestor=c.ancestor AND x.descendant=s.child)
+                    GROUP BY c.ancestor, s.child
+                    """, (depth + 1, depth))
+                if cursor.rowcount <= 0:
+                    break
+                depth += 1
+            db("""
+                DELETE FROM {0} WHERE name=%s
+                """.format(db.quote('system')), ('subtickets_closure',))
+            db("""
+                INSERT INTO {0} (name, value) VALUES (%s, %s)
+                """.format(db.quote('system')), ('subtickets_closure', '1'))
+        self._closure_valid = True
+
+    def relations_reset(self):
+        """Update the data derived from the `subtickets` table after it
+        has been changed in bulk: the caches are emptied, the children
+        counts rebuilt and the closure table rebuilt, or marked as
+        outdated if disabled.
+        """
+        del self._subtree_cache
+        del self._rollup_cache
+        self.rebuild_counts()
+        if self.opt_closure_table:
+            self.rebuild_closure()
+        else:
+            with self.env.db_transaction as db:
+                db("""
+                    DELETE FROM {0} WHERE name=%s
+                    """.format(db.quote('system')), ('subtickets_closure',))
+            self._closure_valid = False
+
+    def _closure_enabled(self):
+        if not self.opt_closure_table:
+            return False
+        if not self._closure_valid:
+            with self.env.db_transaction as db:
+                if not db("""
+                        SELECT value FROM {0} WHERE name=%s
+                        """.format(db.quote('system')),
+                        ('subtickets_closure',)):
+                    self.log.info("Rebuilding the subtickets closure table")
+                    self.rebuild_closure()
+            self._closure_valid = True
+        return True
+
+    def _relations_changed(self, db, parents, child):
+        """Keep the closure table up to date after the relations between
+        `parents` and `child` have been added or removed, or mark it as
+        outdated if it is disabled.
+        """
+        if not parents:
+            return
+        del self._subtree_cache
+        if self.opt_rollup:
+            del self._rollup_cache
+        if self._closure_enabled():
+            self._update_closure(db, parents, child)
+        elif self._closure_valid is not False:
+            db("""
+                DELETE FROM {0} WHERE name=%s
+                """.format(db.quote('system')), ('subtickets_closure',))
+            self._closure_valid = False
+
+    def _update_closure(self, db, parents, child):
+        # Only the distances from the parents and their ancestors to the
+        # child and its descendants can change. They are recomputed
+        # bottom-up from the relations of the affected ancestors, and from
+        # the rows of all other tickets which stay valid.
+        child = int(child)
+        affected = set(int(parent) for parent in parents)
+        for chunk in _chunks(sorted(affected)):
+            for ancestor, in db("""
+                    SELECT ancestor FROM subtickets_closure
+                    WHERE descendant IN ({0})
+                    """.format(','.join(['%s'] * len(chunk))), chunk):
+                affected.add(ancestor)
+        below = set([child])
+        below.update(descendant for descendant, in db("""
+            SELECT descendant FROM subtickets_closure WHERE ancestor=%s
+            """, (child, )))
+
+        distances = {}  # {ancestor: {descendant: depth}}
+        outdated = []
+        for chunk in _chunks(sorted(below)):
+            for ancestor, descendant, depth in db("""
+                    SELECT ancestor, descendant, depth FROM subtickets_closure
+                    WHERE descendant IN ({0})
+                    """.format(','.join(['%s'] * len(chunk))), chunk):
+                if ancestor in affected:
+                    outdated.append((ancestor, descendant))
+                else:
+                    distances.setdefault(ancestor, {})[descendant] = depth
+        for id in below:
+            distances.setdefault(id, {})[id] = 0
+
+        children = {}
+        for chunk in _chunks(sorted(affected)):
+            for parent, child_id in db("""
+                    SELECT parent, child FROM subtickets
+                    WHERE parent IN ({0})
+                    """.format(','.join(['%s'] * len(chunk))), chunk):
+                children.setdefault(parent, []).append(child_id)
+
+        # visit the affected ancestors after their affected children
+        waiting = dict((id, set(x for x in children.get(id, ())
+                                if x in affected)) for id in affected)
+        waited_by = {}
+        for id, ids in waiting.items():
+            for x in ids:
+                waited_by.setdefault(x, []).append(id)
+        ready = [id for id, ids in waiting.items() if not ids]
+        rows = []
+        while ready:
+            id = ready.pop()
+            reach = {}
+            for x in children.get(id, ()):
+                for descendant, depth in distances.get(x, {}).items():
+                    if descendant not in reach or depth + 1 < reach[descendant]:
+                        reach[descendant] = depth + 1
+            distances[id] = reach
+            rows.extend((id, descendant, depth)
+                        for descendant, depth in reach.items())
+            for x in waited_by.get(id, ()):
+                waiting[x].discard(id)
+                if not waiting[x]:
+                    ready.append(x)
+
+        db.executemany("""
+            DELETE FROM subtickets_closure WHERE ancestor=%s AND descendant=%s
+            """, outdated)
+        db.executemany("""
+            INSERT INTO subtickets_closure (ancestor, descendant, depth)
+            VALUES (%s, %s, %s)
+            """, rows)
+
+    # Notifications
+
+    @instrumented(nodes=lambda ticket, author: 1)
     def send_notification(self, ticket, author):
+        try:
+            self._send_notification(ticket, author, ticket['changetime'])
+        except Exception as e:
+            self.log.error("Failure sending notification on change to "
+                           "ticket #%s: %s",
+                           ticket.id, exception_to_unicode(e))
+
+    def process_notification_queue(self, limit=None):
+        """Send the queued notifications which are due and return the
+        number of sent and of failed notifications.
+
+        A failed notification is tried again later, waiting twice as long
+        after each attempt, until `notification_max_attempts` is reached.
+        """
+        now = to_utimestamp(datetime.now(utc))
+        sql = """
+            SELECT id, ticket, time, author, attempts, next_attempt
+            FROM subtickets_notify_queue WHERE next_attempt<=%s ORDER BY id
+            """
+        if limit:
+            sql += " LIMIT %d" % limit
+        sent = failed = 0
+        for id, tkt_id, time, author, attempts, next_attempt in \
+                self.env.db_query(sql, (now, )):
+            # claim the entry, in case several processes drain the queue
+            with self.env.db_transaction as db:
+                cursor = db.cursor()
+                cursor.execute("""
+                    UPDATE subtickets_notify_queue SET next_attempt=%s
+                    WHERE id=%s AND next_attempt=%s
+                    """, (now + QUEUE_LEASE, id, next_attempt))
+                if cursor.rowcount != 1:
+                    continue
+            try:
+                ticket = Ticket(self.env, tkt_id)
+                self._send_notification(ticket, author,
+                                        from_utimestamp(time))
+            except ResourceNotFound:
+                self.env.db_transaction("""
+                    DELETE FROM subtickets_notify_queue WHERE id=%s
+                    """, (id, ))
+            except Exception as e:
+                failed += 1
+                attempts += 1
+                if attempts >= self.opt_notification_max_attempts:
+                    self.log.error("Giving up sending notification on "
+                                   "change to ticket #%s after %d "
+                                   "attempts: %s", tkt_id, attempts,
+                                   exception_to_unicode(e))
+                    self.env.db_transaction("""
+                        DELETE FROM subtickets_notify_queue WHERE id=%s
+                        """, (id, ))
+                else:
+                    self.log.warning("Failure sending notification on "
+                                     "change to ticket #%s, trying again "
+                                     "later: %s", tkt_id,
+                                     exception_to_unicode(e))
+                    self.env.db_transaction("""
+                        UPDATE subtickets_notify_queue
+                        SET attempts=%s, next_attempt=%s WHERE id=%s
+                        """, (attempts, now + QUEUE_RETRY_DELAY *
+                              2 ** (attempts - 1), id))
+            else:
+                sent += 1
+                self.env.db_transaction("""
+                    DELETE FROM subtickets_notify_queue WHERE id=%s
+                    """, (id, ))
+        return sent, failed
+
+    def _notify(self, db, ticket, author):
+        if self.opt_notification_queue:
+            db("""
+                INSERT INTO subtickets_notify_queue
+                    (ticket, time, author, attempts, next_attempt)
+                VALUES (%s, %s, %s, 0, 0)
+                """, (ticket.id, to_utimestamp(ticket['changetime']), author))
+        else:
+            self.send_notification(ticket, author)
+
+    def _send_notification(self, ticket, author, modtime):
         if TicketNotifyEmail:
             tn = TicketNotifyEmail(self.env)
-            tn.notify(ticket, newticket=False, modtime=ticket['changetime'])
+            tn.notify(ticket, newticket=False, modtime=modtime)
         else:
-            event = TicketChangeEvent('changed', ticket, ticket['changetime'],
-                                      author)
+            event = TicketChangeEvent('changed', ticket, modtime, author)
+            NotificationSystem(self.env).notify(event)
+
+    # Instrumentation
+
+    def record_call(self, name, seconds, queries, nodes):
+        """Add a call of the hook `name` to the instrumentation stats, and
+        log it if it lasted longer than the threshold.
+        """
+        with self._stats_lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'queries': 0, 'max_queries': 0, 'nodes': 0,
+                    'buckets': [0] * (len(HISTOGRAM_BUCKETS) + 1)}
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['queries'] += queries
+            stats['max_queries'] = max(stats['max_queries'], queries)
+            stats['nodes'] += nodes
+            idx = 0
+            while idx < len(HISTOGRAM_BUCKETS) and \
+                    seconds > HISTOGRAM_BUCKETS[idx]:
+                idx += 1
+            stats['buckets'][idx] += 1
+        if seconds >= self.opt_instrumentation_threshold:
+            self.log.warning("Subtickets: %s took %.3fs, %d SQL statements, "
+                             "%d tickets", name, seconds, queries, nodes)
+
+    def get_stats(self):
+        """Return a copy of the instrumentation stats of this process, as
+        a `{name: {'count', 'seconds', 'max_seconds', 'queries',
+        'max_queries', 'nodes', 'buckets'}}` dictionary, `buckets` holding
+        the number of calls per `HISTOGRAM_BUCKETS` interval.
+        """
+        with self._stats_lock:
+            return dict((name, dict(stats, buckets=list(stats['buckets'])))
+                        for name, stats in self._stats.items())
+
+
+class LRUCache(object):
+    """Thread-safe mapping holding at most `size` items, dropping the least
+    recently used ones first.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
             try:
-                NotificationSystem(self.env).notify(event)
-            except Exception as e:
-                self.log.error("Failure sending notification on change to "
-                               "ticket #%s: %s",
-                               ticket.id, exception_to_unicode(e))
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+def _format_ids(tickets, limit=20):
+    ids = sorted(set(id for id, summary in tickets))
+    text = ', '.join('#%s' % id for id in ids[:limit])
+    if len(ids) > limit:
+        text += u', \u2026 (%d)' % len(ids)
+    return text
+
+
+def _count_nodes(tree):
+    count = 0
+    stack = [tree] if tree else []
+    while stack:
+        nodes = stack.pop()
+        count += len(nodes)
+        stack.extend(n for n in nodes.values() if n)
+    return count
+
+
+def _field_column(ticket_fields, name, table, id_expr, joins, join_args):
+    """Return the expression of the value of field `name` of the ticket
+    `table`, whose id is `id_expr`, adding the join it needs to `joins`
+    and its parameters to `join_args`.
+    """
+    if ticket_fields[name].get('custom'):
+        alias = 'c%d' % len(joins)
+        joins.append("""
+            LEFT OUTER JOIN ticket_custom {0}
+            ON {0}.ticket={1} AND {0}.name=%s
+            """.format(alias, id_expr))
+        join_args.append(name)
+        return alias + '.value'
+    return '%s.%s' % (table, name)
+
+
+def _convert_values(fields, values, time_fields):
+    """Convert the database `values` of `fields` like `Ticket` does."""
+    result = []
+    for name, value in zip(fields, values):
+        if name in time_fields:
+            try:
+                value = from_utimestamp(int(value)) if value else None
+            except ValueError:
+                value = None
+        elif value is None:
+            value = empty
+        result.append(value)
+    return tuple(result)
+
+
+def _build_tree(id, edges, max_depth=-1, limit=None):
+    """Build the tree of `get_tree` below `id` from the `edges` loaded,
+    stopping after `limit` tickets if given. Return the tree and the
+    list of the tickets expanded in it, starting with `id`.
+    """
+    tree = {}
+    expanded = [id]
+    visited = set(expanded)
+    stack = [(tree, child, 0)
+             for child in sorted(edges.get(id, ()), reverse=True)]
+    count = 0
+    while stack and (limit is None or count < limit):
+        children, node, depth = stack.pop()
+        count += 1
+        if node in visited or max_depth != -1 and depth >= max_depth:
+            children[node] = None
+            continue
+        visited.add(node)
+        expanded.append(node)
+        children[node] = {}
+        stack.extend((children[node], child, depth + 1)
+                     for child in sorted(edges.get(node, ()), reverse=True))
+    return tree, expanded
+
+
+def _add_edge(edges, src, dst):
+    edges.setdefault(int(src), []).append(int(dst))
+
+
+def _chunks(items, size=IN_CLAUSE_SIZE):
+    items = list(items)
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
@@ -27,71 +27,288 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import csv
+import json
+import multiprocessing
 import sys
+from functools import partial
+from itertools import groupby
 from optparse import OptionParser
 
 from trac.env import open_environment
+from trac.util.text import exception_to_unicode
 
-from .api import NUMBERS_RE
+from .api import IN_CLAUSE_SIZE, NUMBERS_RE, _chunks
 
+# exit codes of main()
+EXIT_OK = 0
+EXIT_MISMATCH = 1
+EXIT_ERROR = 2
 
-def check_subtickets(db):
-    cursor = db.cursor()
+# rows read per statement
+FETCH_SIZE = 1000
 
-    cfield = {}
-    cursor.execute(
-        "SELECT ticket, value FROM ticket_custom WHERE name='parents'")
-    for row in cursor:
-        id = row[0]
-        parents = [int(x) for x in NUMBERS_RE.findall(row[1])]
-        cfield[id] = parents
+# names of the `system` entries holding the `changetime` up to which the
+# tickets have been checked, and the ids of those found inconsistent
+CHECKED_NAME = 'subtickets_checked'
+MISMATCHES_NAME = 'subtickets_mismatches'
 
-    subtickets = {}
-    cursor.execute("SELECT parent, child FROM subtickets")
-    for row in cursor:
-        parent = int(row[0])
-        child = int(row[1])
-        if child in subtickets:
-            subtickets[child] += [parent]
+
+def _select_ordered(db, query, columns, ids):
+    """Execute `query` for all rows, or only for those whose first of
+    `columns` is in `ids`, and generate the rows in the order of
+    `columns`, which `query` selects first.
+
+    The rows are read `FETCH_SIZE` at a time, each statement resuming
+    after the last row read by the previous one, since the cursors of
+    Trac's database backends hold the whole result of a statement.
+    """
+    if ids is None:
+        chunks = [None]
+    else:
+        chunks = _chunks(sorted(ids))
+    first = columns[0]
+    for chunk in chunks:
+        where, args = '', []
+        if chunk is not None:
+            where = ' AND %s IN (%s)' % (first, ','.join(['%s'] * len(chunk)))
+            args = list(chunk)
+        last = None
+        while True:
+            keyset, keyset_args = '', []
+            if last is not None and len(columns) > 1:
+                keyset = ' AND (%s>%%s OR %s=%%s AND %s>%%s)' \
+                         % (first, first, columns[1])
+                keyset_args = [last[0], last[0], last[1]]
+            elif last is not None:
+                keyset = ' AND %s>%%s' % first
+                keyset_args = [last[0]]
+            rows = db(query.format(where + keyset, ', '.join(columns)),
+                      args + keyset_args + [FETCH_SIZE])
+            for row in rows:
+                yield row
+            if len(rows) < FETCH_SIZE:
+                break
+            last = rows[-1]
+
+
+def _custom_field_parents(db, ids=None):
+    for id, value in _select_ordered(db, """
+            SELECT ticket, value FROM ticket_custom WHERE name='parents' {0}
+            ORDER BY {1} LIMIT %s""", ('ticket',), ids):
+        yield int(id), set(int(x) for x in NUMBERS_RE.findall(value or ''))
+
+
+def _subtickets_parents(db, ids=None):
+    rows = _select_ordered(db, """
+        SELECT child, parent FROM subtickets WHERE 1=1 {0} ORDER BY {1}
+        LIMIT %s""", ('child', 'parent'), ids)
+    for child, rows in groupby(rows, lambda row: row[0]):
+        yield int(child), set(int(row[1]) for row in rows)
+
+
+def get_changed_tickets(db, since):
+    """Return the ids of the tickets changed after the `since` timestamp,
+    in microseconds, together with the tickets they are related to.
+    """
+    changed = set(id for id, in db("""
+        SELECT id FROM ticket WHERE changetime>%s""", (since,)))
+    ids = set(changed)
+    for id, parents in _custom_field_parents(db, changed):
+        ids.update(parents)
+    for chunk in _chunks(sorted(changed), IN_CLAUSE_SIZE // 2):
+        for parent, child in db("""
+                SELECT parent, child FROM subtickets
+                WHERE parent IN ({0}) OR child IN ({0})
+                """.format(','.join(['%s'] * len(chunk))), chunk * 2):
+            ids.add(int(parent))
+            ids.add(int(child))
+    return ids
+
+
+def check_subtickets(db, ids=None):
+    """Compare the `parents` custom field of the tickets with the
+    `subtickets` table, and generate a `(id, cfield, subtickets)` tuple for
+    each ticket where they differ, `None` standing for a missing side.
+
+    Both are read in ticket order, in batches, and merged, so that memory
+    use does not depend on the number of tickets. Only the tickets in
+    `ids` are checked if given.
+    """
+    cfield = _custom_field_parents(db, ids)
+    subtickets = _subtickets_parents(db, ids)
+    left = next(cfield, None)
+    right = next(subtickets, None)
+    while left is not None or right is not None:
+        if right is None or left is not None and left[0] < right[0]:
+            if left[1]:
+                yield left[0], left[1], None
+            left = next(cfield, None)
+        elif left is None or right[0] < left[0]:
+            yield right[0], None, right[1]
+            right = next(subtickets, None)
         else:
-            subtickets[child] = [parent]
+            if left[1] != right[1]:
+                yield left[0], left[1], right[1]
+            left = next(cfield, None)
+            right = next(subtickets, None)
+
+
+def get_checked(db):
+    """Return the `changetime` up to which the tickets were checked by
+    the last check, or `None`.
+    """
+    for value, in db("""
+            SELECT value FROM {0} WHERE name=%s
+            """.format(db.quote('system')), (CHECKED_NAME,)):
+        return int(value)
+    return None
+
+
+def get_mismatches(db):
+    """Return the ids of the tickets found inconsistent by the last
+    check.
+    """
+    for value, in db("""
+            SELECT value FROM {0} WHERE name=%s
+            """.format(db.quote('system')), (MISMATCHES_NAME,)):
+        return set(int(id) for id in NUMBERS_RE.findall(value))
+    return set()
+
+
+def set_checked(db, changetime, mismatches=()):
+    """Record that the tickets were checked up to `changetime`, and that
+    the tickets of `mismatches` have to be checked again.
+    """
+    for name, value in ((CHECKED_NAME, str(changetime)),
+                        (MISMATCHES_NAME,
+                         ','.join(str(id) for id in sorted(mismatches)))):
+        db("DELETE FROM {0} WHERE name=%s".format(db.quote('system')),
+           (name,))
+        db("INSERT INTO {0} (name, value) VALUES (%s, %s)"
+           .format(db.quote('system')), (name, value))
 
-    for id in set(cfield.keys() + subtickets.keys()):
-        result = False
-        if id in cfield and id in subtickets:
-            cfield_values = set(cfield[id])
-            subtickets_values = set(subtickets[id])
-            if cfield_values == subtickets_values:
-                result = True
-        elif id not in subtickets:
-            if not cfield.get(id):
-                result = True
 
-        if not result:
-            print("Mismatch in ticket #%i" % id)
-            print("  custom field :", cfield.get(id, '--'))
-            print("  subtickets   :", subtickets.get(id, '--'))
+def check_tickets(env, full=False):
+    """Check the tickets of `env` and return the list of mismatches,
+    as dictionaries.
+
+    Unless `full` is `True`, only the tickets changed since the last
+    check, the tickets they are related to and the tickets found
+    inconsistent by the last check are checked.
+    """
+    mismatches = []
+    with env.db_query as db:
+        since = None if full else get_checked(db)
+        last, = db("SELECT MAX(changetime) FROM ticket")[0]
+        ids = None
+        if since is not None:
+            ids = get_changed_tickets(db, since) | get_mismatches(db)
+        for id, cfield, subtickets in check_subtickets(db, ids):
+            mismatches.append({
+                'ticket': id,
+                'custom_field': sorted(cfield)
+                                if cfield is not None else None,
+                'subtickets': sorted(subtickets)
+                              if subtickets is not None else None,
+            })
+    # mismatches are checked, and reported, again until fixed
+    if last is not None:
+        with env.db_transaction as db:
+            set_checked(db, last, [m['ticket'] for m in mismatches])
+    return mismatches
+
+
+def check_environment(path, full=False):
+    """Check the environment at `path` like `check_tickets`, and return
+    a dictionary holding its `path`, the list of `mismatches` and an
+    `error` message if the check could not be done.
+    """
+    result = {'path': path, 'mismatches': [], 'error': None}
+    try:
+        env = open_environment(path)
+        result['mismatches'] = check_tickets(env, full)
+    except Exception as e:
+        result['error'] = exception_to_unicode(e)
+    return result
+
+
+def _format_parents(parents):
+    return ' '.join(str(id) for id in parents) if parents is not None \
+           else ''
+
+
+def write_text(out, results):
+    for result in results:
+        if len(results) > 1:
+            out.write("%s:\n" % result['path'])
+        if result['error']:
+            out.write("  Error: %s\n" % result['error'])
+        for m in result['mismatches']:
+            out.write("Mismatch in ticket #%i\n" % m['ticket'])
+            out.write("  custom field : %s\n" % (m['custom_field'] or '--'))
+            out.write("  subtickets   : %s\n" % (m['subtickets'] or '--'))
+
+
+def write_json(out, results):
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+def write_csv(out, results):
+    writer = csv.writer(out)
+    writer.writerow(['path', 'ticket', 'custom_field', 'subtickets',
+                     'error'])
+    for result in results:
+        if result['error']:
+            writer.writerow([result['path'], '', '', '', result['error']])
+        for m in result['mismatches']:
+            writer.writerow([result['path'], m['ticket'],
+                             _format_parents(m['custom_field']),
+                             _format_parents(m['subtickets']), ''])
+
+
+WRITERS = {'text': write_text, 'json': write_json, 'csv': write_csv}
 
 
 def main(args=sys.argv[1:]):
     parser = OptionParser('%prog [options] project <project2> <project3> ...')
+    parser.add_option('-f', '--format', choices=sorted(WRITERS),
+                      default='text',
+                      help="output format: text (default), json or csv")
+    parser.add_option('-j', '--jobs', type='int', default=0,
+                      help="number of environments checked in parallel, "
+                           "defaults to the number of CPUs")
+    parser.add_option('--full', action='store_true', default=False,
+                      help="check all tickets, not only those changed "
+                           "since the last check")
     options, args = parser.parse_args(args)
 
     # if no projects, print usage
     if not args:
         parser.print_help()
-        sys.exit(0)
-
-    # get the environments
-    envs = []
-    for arg in args:
-        env = open_environment(arg)
-        envs.append(env)
+        sys.exit(EXIT_OK)
 
     # check all the environments
-    for env in envs:
-        with env.db_query as db:
-            check_subtickets(db)
+    check = partial(check_environment, full=options.full)
+    jobs = min(options.jobs or multiprocessing.cpu_count(), len(args))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(check, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [check(arg) for arg in args]
+
+    WRITERS[options.format](sys.stdout, results)
+
+    if any(result['error'] for result in results):
+        sys.exit(EXIT_ERROR)
+    if any(result['mismatches'] for result in results):
+        sys.exit(EXIT_MISMATCH)
+    sys.exit(EXIT_OK)
 
 
 if __name__ == '__main__':
@@ -27,13 +27,34 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from trac.db import Table, Column
+from trac.db import Table, Column, Index
 
 name = 'subtickets'
-version = 2
+version = 6
 tables = [
     Table(name, key=('parent', 'child'))[
         Column('parent', type='int'),
         Column('child', type='int'),
+        Index(['child']),
+    ],
+    Table('subtickets_closure', key=('ancestor', 'descendant'))[
+        Column('ancestor', type='int'),
+        Column('descendant', type='int'),
+        Column('depth', type='int'),
+        Index(['descendant']),
+    ],
+    Table('subtickets_notify_queue', key='id')[
+        Column('id', auto_increment=True),
+        Column('ticket', type='int'),
+        Column('time', type='int64'),
+        Column('author'),
+        Column('attempts', type='int'),
+        Column('next_attempt', type='int64'),
+        Index(['next_attempt']),
+    ],
+    Table('subtickets_counts', key='parent')[
+        Column('parent', type='int'),
+        Column('open_children', type='int'),
+        Column('total_children', type='int'),
     ],
 ]
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Takashi Ito
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Serialization of the relations generated by
+`SubTicketsSystem.export_relations`, shared by the export page and the
+`subtickets export` command.
+"""
+
+import csv
+import json
+from collections import OrderedDict
+from itertools import chain
+
+from trac.util.datefmt import format_datetime, utc
+from trac.util.text import to_unicode
+
+
+def export_ndjson(relations, fields):
+    """Generate one line of JSON per relation."""
+    for parent, child, parent_values, child_values in relations:
+        record = OrderedDict([('parent', parent), ('child', child)])
+        for prefix, values in (('parent_', parent_values),
+                               ('child_', child_values)):
+            for name, value in zip(fields, values):
+                record[prefix + name] = _format_value(value)
+        yield json.dumps(record) + '\n'
+
+
+def export_csv(relations, fields):
+    """Generate a header line and one line of CSV per relation."""
+    header = ['parent', 'child'] + ['parent_' + name for name in fields] + \
+             ['child_' + name for name in fields]
+    rows = ([parent, child] + list(parent_values) + list(child_values)
+            for parent, child, parent_values, child_values in relations)
+    for line in csv_lines(header, rows):
+        yield line
+
+
+def export_dot(relations, fields):
+    """Generate a Graphviz digraph with one edge per relation, whose
+    nodes are labelled with the values of `fields` if any.
+    """
+    yield 'digraph subtickets {\n'
+    declared = None
+    for parent, child, parent_values, child_values in relations:
+        if fields:
+            # relations come sorted by parent
+            if parent != declared:
+                yield '  %d [label=%s];\n' % (parent,
+                                              _dot_label(parent,
+                                                         parent_values))
+                declared = parent
+            yield '  %d [label=%s];\n' % (child,
+                                          _dot_label(child, child_values))
+        yield '  %d -> %d;\n' % (parent, child)
+    yield '}\n'
+
+
+# {format: (function, content type)}
+FORMATS = {
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+    'csv': (export_csv, 'text/csv'),
+    'dot': (export_dot, 'text/vnd.graphviz'),
+}
+
+
+def csv_lines(header, rows):
+    """Generate the lines of CSV of `header` and `rows`, one at a time."""
+    lines = []
+    writer = csv.writer(_LineCollector(lines))
+    for row in chain([header], rows):
+        writer.writerow([_csv_cell(value) for value in row])
+        for line in lines:
+            yield to_unicode(line)
+        del lines[:]
+
+
+class _LineCollector(object):
+    """File-like object collecting the lines written by a CSV writer."""
+
+    def __init__(self, lines):
+        self.write = lines.append
+
+
+def _csv_cell(value):
+    value = to_unicode(_format_value(value))
+    # the csv module of Python 2 only handles byte strings
+    return value.encode('utf-8') if str is bytes else value
+
+
+def _format_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'tzinfo'):
+        return format_datetime(value, 'iso8601', utc)
+    return value
+
+
+def _dot_label(id, values):
+    label = '\n'.join(['#%d' % id] +
+                      [to_unicode(_format_value(value)) for value in values])
+    return '"%s"' % label.replace('\\', '\\\\').replace('"', '\\"') \
+                         .replace('\n', '\\n')
@@ -7,4 +7,104 @@ jQuery(function($) {
     div.html(subtickets_div);
     $(ticketbox).append(div.contents());
   }
+
+  if (typeof subtickets_url === 'undefined')
+    return;
+
+  function createRow(item, depth) {
+    var row = $('<tr>').attr('data-id', item.id).attr('data-depth', depth);
+    var cell = $('<td>').css('padding-left', (depth * 15) + 'px');
+    if (item.children)
+      cell.append($('<span class="subtickets-expander">')
+                  .attr('title', $('.subtickets-expander').attr('title'))
+                  .attr('data-count', item.children));
+    var link = $('<a>').attr('href', item.href).text('#' + item.id);
+    if (item.closed)
+      link.addClass('closed');
+    cell.append(link, document.createTextNode(': ' + item.summary));
+    row.append(cell);
+    $.each(item.columns, function(i, column) {
+      cell = $('<td>');
+      if (column[1] !== null)
+        cell.append($('<a>').attr('href', column[1]).text(column[0]));
+      else
+        cell.text(column[0]);
+      row.append(cell);
+    });
+    return row;
+  }
+
+  function descendants(row) {
+    var depth = row.data('depth');
+    var rows = [];
+    row.nextAll('tr').each(function() {
+      if ($(this).data('depth') <= depth)
+        return false;
+      rows.push(this);
+    });
+    return $(rows);
+  }
+
+  function createMoreRow(parent, offset, count, depth) {
+    var link = $('<a>').attr('href', subtickets_url + '/' + parent +
+                                     '/children?offset=' + offset)
+                       .text(subtickets_more_label.replace('%(count)s',
+                                                           count));
+    return $('<tr class="subtickets-more">')
+      .attr('data-parent', parent).attr('data-offset', offset)
+      .attr('data-count', count).attr('data-depth', depth)
+      .append($('<td>').css('padding-left', (depth * 15) + 'px')
+                       .append(link));
+  }
+
+  // insert a page of the children of `parent` after `row`, followed by a
+  // row for the `count` remaining ones
+  function loadChildren(row, parent, offset, count, depth, done) {
+    var args = {offset: offset};
+    if (subtickets_page_size > 0)
+      args.limit = subtickets_page_size;
+    row.addClass('loading');
+    $.getJSON(subtickets_url + '/' + parent + '/children', args,
+              function(items) {
+      var last = row;
+      $.each(items, function(i, item) {
+        var child = createRow(item, depth);
+        last.after(child);
+        last = child;
+      });
+      if (items.length && items.length < count)
+        last.after(createMoreRow(parent, offset + items.length,
+                                 count - items.length, depth));
+      done();
+    }).always(function() {
+      row.removeClass('loading');
+    });
+  }
+
+  $(document).on('click', 'table.subtickets tr.subtickets-more a',
+                 function(event) {
+    event.preventDefault();
+    var row = $(this).closest('tr');
+    if (row.hasClass('loading'))
+      return;
+    loadChildren(row, row.data('parent'), row.data('offset'),
+                 row.data('count'), row.data('depth'), function() {
+      row.remove();
+    });
+  });
+
+  $(document).on('click', 'table.subtickets .subtickets-expander', function() {
+    var row = $(this).closest('tr');
+    if (row.hasClass('expanded')) {
+      descendants(row).remove();
+      row.removeClass('expanded');
+      return;
+    }
+    if (row.hasClass('loading'))
+      return;
+    loadChildren(row, row.data('id'), 0, $(this).data('count'),
+                 row.data('depth') + 1, function() {
+      row.addClass('expanded');
+    });
+  });
 });
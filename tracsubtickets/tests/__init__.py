@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+from datetime import datetime
 
 from trac.ticket.model import Ticket
+from trac.util.datefmt import to_utimestamp, utc
+
+from ..api import SubTicketsSystem, record_queries
 
 
 def insert_ticket(env, **kwargs):
@@ -12,8 +16,58 @@ def insert_ticket(env, **kwargs):
     return t.insert()
 
 
+def insert_hierarchy(env, relations):
+    """Insert ticket #1 and the tickets described by `relations`, a list
+    of `(id, parents)` tuples, directly in the database.
+    """
+    now = to_utimestamp(datetime.now(utc))
+    tickets = [(1, 'task', now, now, 'new', 'root', 'joe')]
+    custom = []
+    subtickets = []
+    for id, parents in relations:
+        tickets.append((id, 'task', now, now, 'new', 'ticket %d' % id,
+                        'joe'))
+        custom.append((id, 'parents', ', '.join(str(p) for p in parents)))
+        subtickets.extend((parent, id) for parent in parents)
+    with env.db_transaction as db:
+        db.executemany("""
+            INSERT INTO ticket (id, type, time, changetime, status, summary,
+                                reporter)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, tickets)
+        db.executemany("""
+            INSERT INTO ticket_custom (ticket, name, value)
+            VALUES (%s, %s, %s)
+            """, custom)
+        db.executemany("""
+            INSERT INTO subtickets (parent, child) VALUES (%s, %s)
+            """, subtickets)
+    SubTicketsSystem(env).rebuild_counts()
+
+
+class QueryCounter(object):
+    """Context manager recording the SQL statements executed through
+    Trac's database cursors, whatever the connection they belong to.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def __enter__(self):
+        self._recording = record_queries()
+        self.queries = self._recording.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._recording.__exit__(*exc_info)
+
+
 def test_suite():
-    from . import api, web_ui
+    from . import admin, api, checker, web_ui
     modules = list(locals().values())
     suite = unittest.TestSuite()
     for module in modules:
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import io
+import sys
+import unittest
+
+from trac.admin.api import AdminCommandError
+from trac.db.api import DatabaseManager
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+
+from .. import api, db_default
+from ..admin import SubTicketsAdmin
+from ..api import SubTicketsSystem
+from . import insert_ticket
+
+
+class SubTicketsAdminTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = env = EnvironmentStub(default_data=True, enable=['trac.*'])
+        env.config.set('ticket-custom', 'parents', 'text')
+        for cls in (SubTicketsSystem, SubTicketsAdmin):
+            env.enable_component(cls)
+        SubTicketsSystem(env).environment_created()
+        with env.db_transaction:
+            insert_ticket(env, summary='1')
+            insert_ticket(env, summary='2', parents='1')
+            insert_ticket(env, summary='3', parents='1, 2')
+            insert_ticket(env, summary='4')
+        with env.db_transaction as db:
+            db("DELETE FROM subtickets WHERE parent=2 AND child=3")
+            db("INSERT INTO subtickets (parent, child) VALUES (1, 4)")
+
+    def tearDown(self):
+        DatabaseManager(self.env).drop_tables(db_default.tables)
+        self.env.reset_db()
+
+    def _run(self, function, *args):
+        stdout = sys.stdout
+        sys.stdout = out = io.StringIO() if str is not bytes \
+                           else io.BytesIO()
+        try:
+            function(*args)
+        finally:
+            sys.stdout = stdout
+        return out.getvalue()
+
+    def _resync(self, *args):
+        return self._run(SubTicketsAdmin(self.env)._do_resync, *args)
+
+    def _export(self, *args):
+        return self._run(SubTicketsAdmin(self.env)._do_export, *args)
+
+    def _relations(self):
+        return sorted(self.env.db_query(
+            "SELECT parent, child FROM subtickets"))
+
+    def test_resync_dry_run(self):
+        self.assertEqual('#3: 1 -> 1, 2\n#4: 1 -> --\n'
+                         '2 tickets would be resynchronized.\n',
+                         self._resync('field', '--dry-run'))
+        self.assertEqual([(1, 2), (1, 3), (1, 4)], self._relations())
+
+    def test_resync_from_field(self):
+        self.env.config.set('subtickets', 'closure_table', 'enabled')
+        self.assertEqual({2: {}, 3: {}, 4: {}},
+                         SubTicketsSystem(self.env).get_tree(1))
+        self.assertEqual('2/2 tickets resynchronized\n',
+                         self._resync('field'))
+        self.assertEqual([(1, 2), (1, 3), (2, 3)], self._relations())
+        self.assertEqual({2: {3: {}}, 3: None},
+                         SubTicketsSystem(self.env).get_tree(1))
+        self.assertEqual([(1, 2, 1), (1, 3, 1), (2, 3, 1)], sorted(
+            self.env.db_query("SELECT * FROM subtickets_closure")))
+        self.assertEqual('', self._resync('field'))
+
+    def test_resync_from_table(self):
+        changes = self.env.db_query("SELECT * FROM ticket_change")
+        self._resync('table')
+        self.assertEqual('1', Ticket(self.env, 3)['parents'])
+        self.assertEqual('1', Ticket(self.env, 4)['parents'])
+        self.assertEqual(changes, self.env.db_query(
+            "SELECT * FROM ticket_change"))
+
+    def test_export(self):
+        self.assertEqual('{"parent": 1, "child": 2}\n'
+                         '{"parent": 1, "child": 3}\n'
+                         '{"parent": 1, "child": 4}\n',
+                         self._export('ndjson'))
+        batch_size = api.EXPORT_BATCH_SIZE
+        api.EXPORT_BATCH_SIZE = 2
+        try:
+            self.assertEqual('parent,child,parent_summary,child_summary\r\n'
+                             '1,2,1,2\r\n1,3,1,3\r\n1,4,1,4\r\n',
+                             self._export('csv', '--fields=summary'))
+        finally:
+            api.EXPORT_BATCH_SIZE = batch_size
+        self.assertEqual('digraph subtickets {\n'
+                         '  1 [label="#1\\n1"];\n'
+                         '  2 [label="#2\\n2"];\n'
+                         '  1 -> 2;\n'
+                         '  3 [label="#3\\n3"];\n'
+                         '  1 -> 3;\n'
+                         '  4 [label="#4\\n4"];\n'
+                         '  1 -> 4;\n'
+                         '}\n',
+                         self._export('dot', '--fields=summary'))
+        self.env.db_transaction("""
+            INSERT INTO subtickets (parent, child) VALUES (4, 5)
+            """)
+        for closure in ('disabled', 'enabled'):
+            self.env.config.set('subtickets', 'closure_table', closure)
+            self.assertEqual('{"parent": 4, "child": 5}\n',
+                             self._export('ndjson', '--root=4'))
+            self.assertEqual('', self._export('ndjson', '--root=5'))
+        self.assertRaises(AdminCommandError, self._export, 'xml')
+        self.assertRaises(AdminCommandError, self._export, 'ndjson',
+                          '--root=%d' % (1 << 40))
+        self.assertRaises(AdminCommandError, self._export, 'csv',
+                          '--fields=summary,nonexistent')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    load = unittest.defaultTestLoader.loadTestsFromTestCase
+    suite.addTest(load(SubTicketsAdminTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
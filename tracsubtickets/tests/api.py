@@ -4,6 +4,7 @@ import unittest
 
 from trac.core import Component, implements
 from trac.db.api import DatabaseManager
+from trac.db.schema import Column, Index, Table
 from trac.test import EnvironmentStub
 from trac.ticket.model import Ticket
 from trac.util.text import to_utf8
@@ -14,9 +15,10 @@ except ImportError:
 import trac.ticket.web_ui
 del trac.ticket.web_ui
 
-from .. import db_default
-from ..api import SubTicketsSystem
-from . import insert_ticket
+from .. import api, db_default
+from ..api import LRUCache, SubTicketsSystem
+from ..upgrades import create_tables, rebuild_table
+from . import QueryCounter, insert_hierarchy, insert_ticket
 
 
 class EmailSenderStub(Component):
@@ -25,8 +27,11 @@ class EmailSenderStub(Component):
 
     def __init__(self):
         self.history = []
+        self.error = None
 
     def send(self, from_addr, recipients, message):
+        if self.error:
+            raise self.error
         self.history.append((from_addr, recipients, message))
 
 
@@ -54,6 +59,53 @@ class SubTicketsSystemTestCase(unittest.TestCase):
                       .format(db.quote('system')), [db_default.name])
         self.assertEqual([(str(db_default.version),)], rows)
 
+    def test_upgrade(self):
+        for version in (1, 2):
+            with self.env.db_transaction as db:
+                db("DROP TABLE subtickets_counts")
+                db("DROP TABLE subtickets_notify_queue")
+                db("DROP TABLE subtickets_closure")
+                db("DROP TABLE subtickets")
+                db("""CREATE TABLE subtickets (parent integer,
+                                               child integer)""")
+                db.executemany("INSERT INTO subtickets VALUES (%s, %s)",
+                               [(1, 2), (1, 3), (3, 4)])
+                db("UPDATE {0} SET value=%s WHERE name=%s"
+                   .format(db.quote('system')), (version, db_default.name))
+            system = SubTicketsSystem(self.env)
+            self.assertTrue(system.environment_needs_upgrade())
+            system.upgrade_environment()
+            self.assertFalse(system.environment_needs_upgrade())
+            self.assertEqual([(1, 2), (1, 3), (3, 4)],
+                             self._fetch_subtickets())
+            self.assertEqual([], self._fetch_closure())
+            with self.env.db_query as db:
+                cursor = db.cursor()
+                cursor.execute("SELECT * FROM subtickets_closure")
+                self.assertEqual(['ancestor', 'descendant', 'depth'],
+                                 [desc[0] for desc in cursor.description])
+
+    def test_rebuild_table(self):
+        old = Table('subtickets_test')[
+            Column('parent', type='int'), Column('child', type='int'),
+            Column('note'), Index(['child'])]
+        new = Table('subtickets_test', key=('parent', 'child'))[
+            Column('parent', type='int'), Column('child', type='int'),
+            Index(['child'])]
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            create_tables(self.env, cursor, [old])
+            db.executemany("INSERT INTO subtickets_test VALUES (%s, %s, %s)",
+                           [(1, 2, 'a'), (1, 3, None), (2, None, 'b')])
+            rebuild_table(self.env, cursor, new)
+        try:
+            self.assertEqual([(1, 2), (1, 3), (2, None)], self.env.db_query(
+                "SELECT * FROM subtickets_test ORDER BY parent, child"))
+            self.assertNotIn('subtickets_test_old',
+                             DatabaseManager(self.env).get_table_names())
+        finally:
+            DatabaseManager(self.env).drop_tables(['subtickets_test'])
+
     def test_subtickets(self):
         with self.env.db_transaction:
             insert_ticket(self.env, type='defect', summary=u'tíckët 1',
@@ -109,6 +161,511 @@ class SubTicketsSystemTestCase(unittest.TestCase):
         Ticket(self.env, 4).delete()
         self.assertEqual([(4, 2)], self._fetch_subtickets())
 
+    def test_coalesce_changes(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', reporter='alice')
+            insert_ticket(self.env, summary='2', reporter='alice')
+        system = SubTicketsSystem(self.env)
+        with system.coalesce_changes():
+            for id_ in range(3, 33):
+                insert_ticket(self.env, summary=str(id_), reporter='bob',
+                              parents='1')
+            insert_ticket(self.env, summary='33', reporter='bob',
+                          parents='2')
+            self.assertEqual([], self._fetch_comments(1))
+        self.assertEqual(31, len(self._fetch_subtickets()))
+        comments = self._fetch_comments(1)
+        self.assertEqual(1, len(comments))
+        self.assertEqual(u'Add subtickets #3, #4, #5, #6, #7, #8, #9, #10, '
+                         u'#11, #12, #13, #14, #15, #16, #17, #18, #19, '
+                         u'#20, #21, #22, \u2026 (30).', comments[0][4])
+        comments = self._fetch_comments(2)
+        self.assertEqual([u'Add a subticket #33 (33).'],
+                         [c[4] for c in comments])
+        self.assertEqual(2, len(self._get_email_history()))
+
+        with system.coalesce_changes():
+            for id_ in (3, 4):
+                ticket = Ticket(self.env, id_)
+                ticket['parents'] = '2'
+                ticket.save_changes('bob')
+        self.assertEqual(u'Remove subtickets #3, #4.',
+                         self._fetch_comments(1)[-1][4])
+        self.assertEqual(u'Add subtickets #3, #4.',
+                         self._fetch_comments(2)[-1][4])
+
+        try:
+            with system.coalesce_changes():
+                ticket = Ticket(self.env, 5)
+                ticket['parents'] = '2'
+                ticket.save_changes('bob')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(2, len(self._fetch_comments(2)))
+
+    def test_notification_queue(self):
+        self.config.set('subtickets', 'notification_queue', 'enabled')
+        self.config.set('subtickets', 'notification_max_attempts', '2')
+        system = SubTicketsSystem(self.env)
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary=u'tíckët 1', reporter='alice')
+            insert_ticket(self.env, summary=u'tíckët 1.1', reporter='bob',
+                          parents='1')
+        self.assertEqual(1, len(self._fetch_comments(1)))
+        self.assertEqual([], self._get_email_history())
+        self.assertEqual((1, 0), system.process_notification_queue())
+        self.assertEqual((0, 0), system.process_notification_queue())
+        emails = self._get_email_history()
+        self.assertEqual(1, len(emails))
+        self.assertIn(to_utf8(u'Add a subticket #2 (tíckët 1.1).'),
+                      emails[0][2])
+
+        EmailSenderStub(self.env).error = IOError('connection refused')
+        insert_ticket(self.env, summary=u'tíckët 1.2', reporter='bob',
+                      parents='1')
+        self.assertEqual((0, 1), system.process_notification_queue())
+        # the retry is not due yet
+        self.assertEqual((0, 0), system.process_notification_queue())
+        self.env.db_transaction("UPDATE subtickets_notify_queue "
+                                "SET next_attempt=0")
+        self.assertEqual((0, 1), system.process_notification_queue())
+        self.assertEqual([], self.env.db_query("SELECT * FROM "
+                                               "subtickets_notify_queue"))
+        self.assertEqual(1, len(self._get_email_history()))
+
+    def test_get_edges(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2', parents='1')
+            insert_ticket(self.env, summary='3', parents='1')
+            insert_ticket(self.env, summary='4', parents='2, 3')
+            insert_ticket(self.env, summary='5', parents='4')
+        system = SubTicketsSystem(self.env)
+        for cte in (True, False):
+            system._recursive_cte = cte
+            edges = system.get_edges([1])
+            self.assertEqual({1: [2, 3], 2: [4], 3: [4], 4: [5]},
+                             dict((k, sorted(v)) for k, v in edges.items()))
+            edges = system.get_edges([1], max_depth=0)
+            self.assertEqual({1: [2, 3]},
+                             dict((k, sorted(v)) for k, v in edges.items()))
+            edges = system.get_edges([5], ancestors=True)
+            self.assertEqual({5: [4], 4: [2, 3], 2: [1], 3: [1]},
+                             dict((k, sorted(v)) for k, v in edges.items()))
+
+    def test_get_tree(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            for id_ in range(2, 302):
+                insert_ticket(self.env, summary=str(id_), parents=str(id_ - 1))
+        system = SubTicketsSystem(self.env)
+        for cte in (True, False):
+            system._recursive_cte = cte
+            del system._subtree_cache
+            tree = system.get_tree(1)
+            depth = 0
+            while tree:
+                tree = list(tree.values())[0]
+                depth += 1
+            self.assertEqual(300, depth)
+            self.assertEqual({2: {3: None}}, system.get_tree(1, 1))
+
+    def test_get_tree_diamonds(self):
+        # 20 levels of two tickets, each a child of both tickets above
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            for id_ in range(2, 42):
+                level = (id_ - 2) // 2
+                parents = '1' if level == 0 else \
+                          '%d, %d' % (level * 2, level * 2 + 1)
+                insert_ticket(self.env, summary=str(id_), parents=parents)
+        tree = SubTicketsSystem(self.env).get_tree(1)
+        self.assertEqual([2, 3], sorted(tree))
+        self.assertEqual([4, 5], sorted(tree[2]))
+        self.assertEqual({4: None, 5: None}, tree[3])
+        self.assertEqual({6: None, 7: None}, tree[2][5])
+        nodes = 0
+        stack = [tree]
+        while stack:
+            children = stack.pop()
+            nodes += len(children)
+            stack.extend(c for c in children.values() if c)
+        self.assertEqual(78, nodes)
+
+    def test_get_tree_page(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            for id_ in range(2, 8):
+                insert_ticket(self.env, summary=str(id_), parents='1')
+            for id_ in range(8, 12):
+                insert_ticket(self.env, summary=str(id_), parents='2')
+            insert_ticket(self.env, summary='12', parents='3, 8')
+        system = SubTicketsSystem(self.env)
+        factor = api.PAGE_EDGES_FACTOR
+        try:
+            # the whole subtree in one statement, then level by level
+            for api.PAGE_EDGES_FACTOR in (factor, 1):
+                del system._subtree_cache
+                tree, counts = system.get_tree_page(1, limit=4)
+                self.assertEqual({2: {8: {12: {}}, 9: {}}}, tree)
+                self.assertEqual({1: 6, 2: 4, 8: 1, 9: 0, 12: 0}, counts)
+                tree, counts = system.get_tree_page(1, 1, 4)
+                self.assertEqual({2: {8: None, 9: None, 10: None}}, tree)
+                self.assertEqual({1: 6, 2: 4}, counts)
+            # the tickets past the first four are not expanded
+            edges = system._subtree_cache.get((1, -1, 4))
+            self.assertEqual([4, 5], [id_ for id_ in (4, 5, 6, 7, 11)
+                                      if id_ in edges])
+        finally:
+            api.PAGE_EDGES_FACTOR = factor
+        tree, counts = system.get_tree_page(1)
+        self.assertEqual(system.get_tree(1), tree)
+        self.assertEqual(6, counts[1])
+
+    def test_get_rollup(self):
+        self.config.set('ticket-custom', 'hours', 'text')
+        self.config.set('subtickets', 'rollup', 'enabled')
+        self.config.set('subtickets', 'rollup_fields', 'hours')
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='new', parents='1',
+                          hours='1.5')
+            insert_ticket(self.env, summary='3', status='closed',
+                          parents='1', hours='2')
+            insert_ticket(self.env, summary='4', status='closed',
+                          parents='2, 3', hours='2')
+            insert_ticket(self.env, summary='5', status='new', parents='4',
+                          hours='n/a')
+        system = SubTicketsSystem(self.env)
+        for closure, cte in [('disabled', True), ('disabled', False),
+                             ('enabled', None)]:
+            self.config.set('subtickets', 'closure_table', closure)
+            system._recursive_cte = cte
+            del system._rollup_cache
+            self.assertEqual(({'new': 2, 'closed': 2}, {'hours': 5.5}),
+                             system.get_rollup(1, ['hours']))
+            self.assertEqual(({'new': 1, 'closed': 1}, {}),
+                             system.get_rollup(2))
+
+        # cached until a descendant changes
+        self.env.db_transaction("UPDATE ticket SET status='closed' WHERE id=5")
+        self.assertEqual(({'new': 2, 'closed': 2}, {'hours': 5.5}),
+                         system.get_rollup(1, ['hours']))
+        ticket = Ticket(self.env, 5)
+        ticket['summary'] = '5.1'
+        ticket.save_changes('joe', 'no rollup field changed')
+        self.assertEqual(({'new': 2, 'closed': 2}, {'hours': 5.5}),
+                         system.get_rollup(1, ['hours']))
+        ticket = Ticket(self.env, 5)
+        ticket['hours'] = '4'
+        ticket.save_changes('joe')
+        self.assertEqual(({'new': 1, 'closed': 3}, {'hours': 9.5}),
+                         system.get_rollup(1, ['hours']))
+
+    def test_counts(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='new', parents='1')
+            insert_ticket(self.env, summary='3', status='closed',
+                          parents='1')
+            insert_ticket(self.env, summary='4', status='new', parents='2')
+        system = SubTicketsSystem(self.env)
+        self.assertEqual({1: (1, 2), 2: (1, 1)},
+                         system.get_counts([1, 2, 3, 4]))
+
+        ticket = Ticket(self.env, 4)
+        ticket['status'] = 'closed'
+        ticket.save_changes('joe')
+        self.assertEqual({1: (1, 2), 2: (0, 1)}, system.get_counts([1, 2]))
+        self.assertEqual([], system.get_open_children(2))
+
+        ticket = Ticket(self.env, 4)
+        ticket['parents'] = '1'
+        ticket['status'] = 'reopened'
+        ticket.save_changes('joe')
+        self.assertEqual({1: (2, 3)}, system.get_counts([1, 2]))
+        self.assertEqual([2, 4], system.get_open_children(1))
+
+        Ticket(self.env, 2).delete()
+        self.assertEqual({1: (1, 2)}, system.get_counts([1, 2]))
+
+        self.env.db_transaction("DELETE FROM subtickets_counts")
+        system.relations_reset()
+        self.assertEqual({1: (1, 2)}, system.get_counts([1, 2]))
+
+    def test_last_child_comment(self):
+        self.config.set('subtickets', 'last_child_comment', 'enabled')
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='new', parents='1')
+            insert_ticket(self.env, summary='3', status='new', parents='1')
+        for id_ in (2, 3):
+            ticket = Ticket(self.env, id_)
+            ticket['status'] = 'closed'
+            ticket['resolution'] = 'fixed'
+            ticket.save_changes('joe')
+        comments = [row[4] for row in self._fetch_comments(1)]
+        self.assertEqual(1, comments.count('All subtickets are closed.'))
+        self.assertEqual('All subtickets are closed.', comments[-1])
+
+    def test_query_tickets(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new', owner='bob')
+            insert_ticket(self.env, summary='2', status='new', owner='bob',
+                          parents='1')
+            insert_ticket(self.env, summary='3', status='closed',
+                          owner='carol', parents='1')
+            insert_ticket(self.env, summary='4', status='new', owner='carol',
+                          parents='2, 3')
+            insert_ticket(self.env, summary='5', status='new', parents='4')
+        system = SubTicketsSystem(self.env)
+        for closure, cte in [('disabled', True), ('disabled', False),
+                             ('enabled', None)]:
+            self.config.set('subtickets', 'closure_table', closure)
+            system._recursive_cte = cte
+            self.assertEqual([(2, '2'), (3, '3'), (4, '4'), (5, '5')],
+                             list(system.query_tickets(1, ['summary'])))
+            self.assertEqual(4, system.count_tickets(1))
+            self.assertEqual([(2,), (3,), (4,)],
+                             list(system.query_tickets(1, [], max_depth=1)))
+            self.assertEqual([(1, 'new'), (2, 'new'), (3, 'closed'),
+                              (4, 'new')],
+                             list(system.query_tickets(5, ['status'],
+                                                       ancestors=True)))
+            constraints = {'status': (True, ['closed']),
+                           'owner': (False, ['bob', 'carol'])}
+            self.assertEqual([(4, 'carol'), (2, 'bob')],
+                             list(system.query_tickets(
+                                 1, ['owner'], constraints=constraints,
+                                 order='owner', desc=True)))
+            self.assertEqual(2, system.count_tickets(
+                1, constraints=constraints))
+            self.assertEqual([(2, ''), (5, '')], list(system.query_tickets(
+                1, ['milestone'], constraints={
+                    'milestone': (False, ['']),
+                    'status': (False, ['new']),
+                    'owner': (True, ['carol'])})))
+            self.assertEqual([(3,), (4,)], list(system.query_tickets(
+                1, [], offset=1, limit=2)))
+            self.assertEqual([], list(system.query_tickets(5, [])))
+            self.assertEqual(0, system.count_tickets(5))
+
+        # the same rows when read one or two per statement
+        batch_size = api.EXPORT_BATCH_SIZE
+        queries = [dict(fields=['owner'], order='owner', desc=desc)
+                   for desc in (False, True)]
+        queries += [dict(fields=['status'], order='time', desc=True),
+                    dict(fields=[], offset=1, limit=3)]
+        expected = [list(system.query_tickets(1, **kwargs))
+                    for kwargs in queries]
+        self.assertEqual([(4, 'carol'), (3, 'carol'), (2, 'bob'),
+                          (5, '< default >')], expected[1])
+        try:
+            for api.EXPORT_BATCH_SIZE in (1, 2):
+                self.assertEqual(expected, [
+                    list(system.query_tickets(1, **kwargs))
+                    for kwargs in queries])
+        finally:
+            api.EXPORT_BATCH_SIZE = batch_size
+
+    def test_export_relations(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2')
+            insert_ticket(self.env, summary='3', parents='1')
+            insert_ticket(self.env, summary='4')
+            insert_ticket(self.env, summary='5', parents='3')
+            insert_ticket(self.env, summary='6', parents='2')
+            ticket = Ticket(self.env, 2)
+            ticket['parents'] = '3'
+            ticket.save_changes('joe')
+            ticket = Ticket(self.env, 4)
+            ticket['parents'] = '5'
+            ticket.save_changes('joe')
+        system = SubTicketsSystem(self.env)
+        expected = [(2, 6, ('2',), ('6',)), (3, 2, ('3',), ('2',)),
+                    (3, 5, ('3',), ('5',)), (5, 4, ('5',), ('4',))]
+        batch_size = api.EXPORT_BATCH_SIZE
+        in_clause_size = api.IN_CLAUSE_SIZE
+        try:
+            for closure, cte in [('disabled', True), ('disabled', False),
+                                 ('enabled', None)]:
+                self.config.set('subtickets', 'closure_table', closure)
+                system._recursive_cte = cte
+                for api.EXPORT_BATCH_SIZE, api.IN_CLAUSE_SIZE in \
+                        [(batch_size, in_clause_size), (1, 1), (1, 2)]:
+                    self.assertEqual(expected, list(
+                        system.export_relations(3, ['summary'])))
+                    self.assertEqual([(5, 4, (), ())],
+                                     list(system.export_relations(5)))
+                    self.assertEqual([], list(system.export_relations(4)))
+        finally:
+            api.EXPORT_BATCH_SIZE = batch_size
+            api.IN_CLAUSE_SIZE = in_clause_size
+
+    def test_subtree_cache(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2', parents='1')
+        system = SubTicketsSystem(self.env)
+        self.assertEqual({2: {}}, system.get_tree(1))
+        # Relations written behind the plugin's back are not seen...
+        self.env.db_transaction("""
+            INSERT INTO subtickets (parent, child) VALUES (1, 9)""")
+        self.assertEqual({2: {}}, system.get_tree(1))
+        # ... until a relation is changed through a ticket.
+        insert_ticket(self.env, summary='3', parents='2')
+        self.assertEqual({2: {3: {}}, 9: {}}, system.get_tree(1))
+        self.assertEqual({2: None, 9: None}, system.get_tree(1, 0))
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set(1, 'a')
+        cache.set(2, 'b')
+        self.assertEqual('a', cache.get(1))
+        cache.set(3, 'c')
+        self.assertIsNone(cache.get(2))
+        self.assertEqual('a', cache.get(1))
+        self.assertEqual('c', cache.get(3))
+        cache = LRUCache(0)
+        cache.set(1, 'a')
+        self.assertIsNone(cache.get(1))
+
+    def test_validate_parents(self):
+        self.config.set('subtickets', 'no_modif_when_parent_closed', 'true')
+        with self.env.db_transaction:
+            for id_ in range(1, 51):
+                insert_ticket(self.env, summary=str(id_),
+                              status='closed' if id_ == 7 else 'new')
+        ticket = Ticket(self.env, 1)
+        ticket['parents'] = ', '.join(str(id_) for id_ in range(1, 53))
+        errors = list(SubTicketsSystem(self.env).validate_ticket(None, ticket))
+        self.assertEqual(4, len(errors))
+        self.assertIn(('parents', 'A ticket cannot be a parent of itself'),
+                      errors)
+        self.assertIn(('parents', 'Ticket #51 does not exist'), errors)
+        self.assertIn(('parents', 'Ticket #52 does not exist'), errors)
+        self.assertIn('parent ticket #7 is closed', errors[-1][1])
+        self.assertEqual(', '.join(str(id_) for id_ in range(2, 51)
+                                   if id_ != 7), ticket['parents'])
+
+    def test_query_budget(self):
+        # 200 tickets below #1, on two levels
+        relations = [(id_, [1]) for id_ in range(2, 12)]
+        relations += [(id_, [2 + (id_ - 12) // 19])
+                      for id_ in range(12, 202)]
+        insert_hierarchy(self.env, relations)
+        system = SubTicketsSystem(self.env)
+        ticket = Ticket(self.env, 201)
+        ticket['parents'] = ', '.join(str(id_) for id_ in range(100, 150))
+        for cte in (True, False):
+            system._recursive_cte = cte
+            with QueryCounter() as counter:
+                errors = list(system.validate_ticket(None, ticket))
+            self.assertEqual([], errors)
+            self.assertLessEqual(counter.count, 4)
+            del system._subtree_cache
+            with QueryCounter() as counter:
+                system.get_tree(1)
+            self.assertLessEqual(counter.count, 4)
+            with QueryCounter() as counter:
+                system.get_ticket_values(range(1, 202))
+                system.count_children(range(1, 202))
+            self.assertLessEqual(counter.count, 2)
+
+    def test_validate_circularity(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2', parents='1')
+            insert_ticket(self.env, summary='3', parents='2')
+        ticket = Ticket(self.env, 1)
+        ticket['parents'] = '3'
+        errors = list(SubTicketsSystem(self.env).validate_ticket(None, ticket))
+        self.assertEqual([('parents', 'Circularity error: #1 > #3 > #2 > #1')],
+                         errors)
+
+    def test_validate_diamonds(self):
+        # 20 levels of two tickets each, both children of the two tickets
+        # on the level above: 2 ** 19 paths lead to the top
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2')
+            for id_ in range(3, 41, 2):
+                parents = '%d, %d' % (id_ - 2, id_ - 1)
+                insert_ticket(self.env, summary=str(id_), parents=parents)
+                insert_ticket(self.env, summary=str(id_ + 1), parents=parents)
+        ticket = Ticket(self.env, 1)
+        ticket['parents'] = '2'
+        errors = list(SubTicketsSystem(self.env).validate_ticket(None, ticket))
+        self.assertEqual([], errors)
+        ticket['parents'] = '39, 40'
+        errors = list(SubTicketsSystem(self.env).validate_ticket(None, ticket))
+        self.assertEqual(2, len(errors))
+        for field, message in errors:
+            self.assertEqual('parents', field)
+            self.assertRegex(message, r'^Circularity error: #1 > #(39|40) > '
+                                      r'(#\d+ > ){18}#1$')
+
+    def test_closure_table(self):
+        self.config.set('subtickets', 'closure_table', 'enabled')
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2', parents='1')
+            insert_ticket(self.env, summary='3', parents='1')
+            insert_ticket(self.env, summary='4', parents='2, 3')
+            insert_ticket(self.env, summary='5', parents='4')
+            insert_ticket(self.env, summary='6')
+        self.assertEqual(self._compute_closure(), self._fetch_closure())
+        self.assertIn((1, 5, 3), self._fetch_closure())
+
+        for id_, parents in ((4, '3'), (2, '6'), (3, '6, 2'), (4, ''),
+                             (1, '5'), (5, '')):
+            tkt = Ticket(self.env, id_)
+            tkt['parents'] = parents
+            tkt.save_changes('alice')
+            self.assertEqual(self._compute_closure(), self._fetch_closure())
+        Ticket(self.env, 2).delete()
+        self.assertEqual(self._compute_closure(), self._fetch_closure())
+
+        system = SubTicketsSystem(self.env)
+        system.rebuild_closure()
+        self.assertEqual(self._compute_closure(), self._fetch_closure())
+        self.assertEqual({6: [3]}, system.get_edges([6], max_depth=0))
+
+    def test_closure_table_enabled_later(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2', parents='1')
+            insert_ticket(self.env, summary='3', parents='2')
+        self.assertEqual([], self._fetch_closure())
+        self.config.set('subtickets', 'closure_table', 'enabled')
+        system = SubTicketsSystem(self.env)
+        self.assertEqual({1: [2], 2: [3]}, system.get_edges([1]))
+        self.assertEqual([(1, 2, 1), (1, 3, 2), (2, 3, 1)],
+                         self._fetch_closure())
+
+    def _compute_closure(self):
+        children = {}
+        for parent, child in self._fetch_subtickets():
+            children.setdefault(parent, []).append(child)
+        closure = []
+        for ancestor in children:
+            depth, level, seen = 0, [ancestor], set()
+            while level:
+                depth += 1
+                level = [c for p in level for c in children.get(p, ())
+                           if c not in seen]
+                for descendant in set(level):
+                    seen.add(descendant)
+                    closure.append((ancestor, descendant, depth))
+        return sorted(closure)
+
+    def _fetch_closure(self):
+        return self.env.db_query('SELECT ancestor, descendant, depth '
+                                 'FROM subtickets_closure '
+                                 'ORDER BY ancestor, descendant')
+
     def _fetch_subtickets(self):
         return self.env.db_query('SELECT parent, child FROM subtickets '
                                  'ORDER BY parent, child')
@@ -125,5 +682,7 @@ def test_suite():
     suite = unittest.TestSuite()
     load = unittest.defaultTestLoader.loadTestsFromTestCase
     for testcase in [SubTicketsSystemTestCase]:
+        if not hasattr(testcase, 'assertRegex'):
+            testcase.assertRegex = testcase.assertRegexpMatches
         suite.addTest(load(testcase))
     return suite
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the subtickets plugin on generated hierarchies.
+
+Not part of the test suite. Run it with
+
+    python -m tracsubtickets.tests.benchmark [options]
+
+and store the results with `--output` to compare a later run against
+them with `--compare`.
+"""
+
+import json
+import sys
+import time
+from optparse import OptionParser
+
+from trac.db.api import DatabaseManager
+from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
+
+from .. import db_default
+from ..api import LRUCache, SubTicketsSystem
+from ..checker import check_subtickets
+from ..web_ui import SubTicketsModule
+from . import QueryCounter, insert_hierarchy
+
+
+def wide_hierarchy(scale):
+    """One ticket with 10,000 children."""
+    size = int(10000 * scale)
+    return [(id, [1]) for id in range(2, size + 2)]
+
+
+def deep_hierarchy(scale):
+    """A chain of 1,000 tickets."""
+    size = int(1000 * scale)
+    return [(id, [id - 1]) for id in range(2, size + 1)]
+
+
+def dag_hierarchy(scale):
+    """50 levels of 20 tickets, each a child of two tickets of the level
+    above, below a single root.
+    """
+    levels, width = int(50 * scale) or 1, 20
+    relations = [(id, [1]) for id in range(2, width + 2)]
+    for level in range(1, levels):
+        first = 2 + level * width
+        for idx in range(width):
+            above = first - width
+            relations.append((first + idx, [above + idx,
+                                            above + (idx + 1) % width]))
+    return relations
+
+
+HIERARCHIES = [('wide', wide_hierarchy), ('deep', deep_hierarchy),
+               ('dag', dag_hierarchy)]
+
+
+def create_environment(relations):
+    """Return an in-memory environment holding ticket #1 and the tickets
+    described by `relations`, a list of `(id, parents)` tuples.
+    """
+    env = EnvironmentStub(default_data=True, enable=['trac.*'])
+    env.config.set('ticket-custom', 'parents', 'text')
+    for cls in (SubTicketsSystem, SubTicketsModule):
+        env.enable_component(cls)
+    SubTicketsSystem(env).environment_created()
+    insert_hierarchy(env, relations)
+    return env
+
+
+def reset_caches(env):
+    del SubTicketsSystem(env)._subtree_cache
+    module = SubTicketsModule(env)
+    module._fragments = LRUCache(module.opt_fragment_cache_size)
+
+
+def operations(env, relations):
+    """Generate the `(name, function)` pairs of the operations measured
+    on `env`.
+    """
+    system = SubTicketsSystem(env)
+    module = SubTicketsModule(env)
+    leaf, parents = relations[-1]
+
+    def view(cached=False):
+        if not cached:
+            reset_caches(env)
+        req = MockRequest(env, path_info='/ticket/1')
+        module.post_process_request(req, 'ticket.html',
+                                    {'ticket': Ticket(env, 1)}, None)
+
+    def validate_parents():
+        ticket = Ticket(env, leaf)
+        ticket['parents'] = ', '.join(str(p) for p in parents)
+        list(system.validate_ticket(None, ticket))
+
+    def validate_resolve():
+        req = MockRequest(env, args={'action': 'resolve'})
+        list(module.validate_ticket(req, Ticket(env, 1)))
+
+    # move the leaf below another ticket and back
+    other = 1 if parents != [1] else relations[0][0]
+    values = [', '.join(str(p) for p in parents), str(other)]
+
+    def change_parents():
+        ticket = Ticket(env, leaf)
+        old, new = values
+        ticket['parents'] = new
+        system.ticket_changed(ticket, '', 'bench', {'parents': old})
+        values.reverse()
+
+    def check():
+        with env.db_query as db:
+            list(check_subtickets(db))
+
+    yield 'post_process_request', view
+    yield 'post_process_request (cached)', lambda: view(True)
+    yield 'SubTicketsSystem.validate_ticket', validate_parents
+    yield 'SubTicketsModule.validate_ticket', validate_resolve
+    yield 'ticket_changed', change_parents
+    yield 'check_subtickets', check
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    idx = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(idx, len(values) - 1)]
+
+
+def measure(function, repeat):
+    """Call `function` `repeat` times, and return its latencies in
+    milliseconds and the median number of queries of a call.
+    """
+    latencies = []
+    counts = []
+    for idx in range(repeat):
+        with QueryCounter() as counter:
+            start = time.time()
+            function()
+            latencies.append((time.time() - start) * 1000)
+        counts.append(counter.count)
+    return {'min': min(latencies), 'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99), 'max': max(latencies),
+            'queries': percentile(counts, 50)}
+
+
+def run(names, scale, repeat, closure_table):
+    results = {}
+    for name, generate in HIERARCHIES:
+        if names and name not in names:
+            continue
+        relations = generate(scale)
+        env = create_environment(relations)
+        env.config.set('subtickets', 'closure_table',
+                       'enabled' if closure_table else 'disabled')
+        env.config.set('subtickets', 'check_all_levels', 'enabled')
+        for operation, function in operations(env, relations):
+            function()  # warm up
+            results['%s: %s' % (name, operation)] = \
+                measure(function, repeat)
+        DatabaseManager(env).drop_tables(db_default.tables)
+        env.reset_db()
+    return results
+
+
+def report(out, results, baseline=None):
+    out.write('%-50s %9s %9s %9s %9s %7s\n'
+              % ('benchmark', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms',
+                 'queries'))
+    for name in sorted(results):
+        r = results[name]
+        line = '%-50s %9.2f %9.2f %9.2f %9.2f %7d' \
+               % (name, r['p50'], r['p90'], r['p99'], r['max'], r['queries'])
+        if baseline and name in baseline and baseline[name]['p50']:
+            line += '  x%.2f' % (r['p50'] / baseline[name]['p50'])
+        out.write(line + '\n')
+
+
+def main(args=sys.argv[1:]):
+    parser = OptionParser('%prog [options] [wide|deep|dag ...]')
+    parser.add_option('-n', '--repeat', type='int', default=10,
+                      help="number of calls measured per benchmark")
+    parser.add_option('-s', '--scale', type='float', default=1.0,
+                      help="factor applied to the size of the hierarchies")
+    parser.add_option('-c', '--closure-table', action='store_true',
+                      default=False, help="enable the closure table")
+    parser.add_option('-o', '--output',
+                      help="write the results as JSON to this file")
+    parser.add_option('--compare',
+                      help="compare with the results stored in this file")
+    options, args = parser.parse_args(args)
+
+    results = run(args, options.scale, options.repeat,
+                  options.closure_table)
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+    report(sys.stdout, results, baseline)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({'scale': options.scale, 'repeat': options.repeat,
+                       'closure_table': options.closure_table,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import unittest
+
+from trac.db.api import DatabaseManager
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+from trac.util.datefmt import to_utimestamp
+
+from .. import checker, db_default
+from ..api import SubTicketsSystem
+from ..checker import check_subtickets, check_tickets, \
+                       get_changed_tickets, get_checked, get_mismatches, \
+                       set_checked, write_csv, write_json
+from . import insert_ticket
+
+
+class CheckerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = env = EnvironmentStub(default_data=True, enable=['trac.*'])
+        env.config.set('ticket-custom', 'parents', 'text')
+        env.enable_component(SubTicketsSystem)
+        SubTicketsSystem(env).environment_created()
+
+    def tearDown(self):
+        DatabaseManager(self.env).drop_tables(db_default.tables)
+        self.env.reset_db()
+
+    def _check(self):
+        with self.env.db_query as db:
+            return list(check_subtickets(db))
+
+    def test_check_subtickets(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2', parents='1')
+            insert_ticket(self.env, summary='3', parents='1, 2')
+            insert_ticket(self.env, summary='4', parents='')
+        self.assertEqual([], self._check())
+
+        with self.env.db_transaction as db:
+            db("DELETE FROM subtickets WHERE parent=2 AND child=3")
+            db("INSERT INTO subtickets (parent, child) VALUES (1, 4)")
+            db("INSERT INTO subtickets (parent, child) VALUES (2, 4)")
+            db("INSERT INTO subtickets (parent, child) VALUES (3, 5)")
+            db("UPDATE ticket_custom SET value='3' WHERE ticket=2")
+        expected = [(2, set([3]), set([1])),
+                    (3, set([1, 2]), set([1])),
+                    (4, set(), set([1, 2])),
+                    (5, None, set([3]))]
+        self.assertEqual(expected, self._check())
+        # the same when read one row per statement
+        fetch_size = checker.FETCH_SIZE
+        checker.FETCH_SIZE = 1
+        try:
+            self.assertEqual(expected, self._check())
+            with self.env.db_query as db:
+                self.assertEqual(expected[1:3],
+                                 list(check_subtickets(db, [3, 4])))
+        finally:
+            checker.FETCH_SIZE = fetch_size
+
+    def test_incremental(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1')
+            insert_ticket(self.env, summary='2', parents='1')
+            insert_ticket(self.env, summary='3', parents='2')
+            insert_ticket(self.env, summary='4')
+            insert_ticket(self.env, summary='5', parents='4')
+        with self.env.db_transaction as db:
+            self.assertIsNone(get_checked(db))
+            last = db("SELECT MAX(changetime) FROM ticket")[0][0]
+            set_checked(db, last)
+        with self.env.db_query as db:
+            self.assertEqual(last, get_checked(db))
+            self.assertEqual(set(), get_changed_tickets(db, last))
+
+        ticket = Ticket(self.env, 2)
+        ticket['summary'] = 'changed'
+        ticket.save_changes('joe')
+        self.env.db_transaction("DELETE FROM subtickets WHERE child=5")
+        with self.env.db_query as db:
+            ids = get_changed_tickets(db, last)
+            self.assertEqual(set([1, 2, 3]), ids)
+            self.assertEqual([], list(check_subtickets(db, ids)))
+            self.assertEqual([(5, set([4]), None)],
+                             list(check_subtickets(db)))
+
+        # the mark advances, and the mismatches are checked again
+        mismatch = {'ticket': 5, 'custom_field': [4], 'subtickets': None}
+        self.assertEqual([mismatch], check_tickets(self.env, full=True))
+        ticket = Ticket(self.env, 1)
+        ticket['summary'] = 'changed'
+        ticket.save_changes('joe')
+        self.assertEqual([mismatch], check_tickets(self.env))
+        with self.env.db_query as db:
+            self.assertEqual(to_utimestamp(ticket['changetime']),
+                             get_checked(db))
+            self.assertEqual(set([5]), get_mismatches(db))
+        self.env.db_transaction("""
+            INSERT INTO subtickets (parent, child) VALUES (4, 5)""")
+        self.assertEqual([], check_tickets(self.env))
+        with self.env.db_query as db:
+            self.assertEqual(set(), get_mismatches(db))
+
+    def test_output(self):
+        results = [{'path': '/envs/a', 'error': None,
+                    'mismatches': [{'ticket': 5, 'custom_field': None,
+                                    'subtickets': [1, 3]}]},
+                   {'path': '/envs/b', 'error': 'No such file',
+                    'mismatches': []}]
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        write_csv(out, results)
+        self.assertEqual(['path,ticket,custom_field,subtickets,error',
+                          '/envs/a,5,,1 3,',
+                          '/envs/b,,,,No such file'],
+                         out.getvalue().splitlines())
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        write_json(out, results)
+        self.assertEqual(results, json.loads(out.getvalue()))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    load = unittest.defaultTestLoader.loadTestsFromTestCase
+    suite.addTest(load(CheckerTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
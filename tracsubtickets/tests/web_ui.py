@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
 
+import json
+import re
 import unittest
 
 from trac.db.api import DatabaseManager
+from trac.perm import PermissionError, PermissionSystem
 from trac.test import EnvironmentStub, MockRequest
+from trac.ticket.model import Ticket
 from trac.ticket.web_ui import TicketModule
+from trac.util import arity
+from trac.web.api import HTTPBadRequest, HTTPNotFound, RequestDone
 from trac.web.main import RequestDispatcher
+import trac.ticket.batch
+del trac.ticket.batch
 
 from .. import db_default
-from ..api import SubTicketsSystem
+from ..api import LRUCache, SubTicketsSystem
 from ..web_ui import SubTicketsModule
-from . import insert_ticket
+from . import QueryCounter, insert_hierarchy, insert_ticket
 
 
 class SubTicketsModuleTestCase(unittest.TestCase):
@@ -42,6 +50,534 @@ class SubTicketsModuleTestCase(unittest.TestCase):
         self.assertRegex(div, u'<td[^>]*><a[^>]*>#2</a>: tíckët 1\\.1</td>')
         self.assertRegex(div, u'<td[^>]*><a[^>]*>#3</a>: tíckët 1\\.2</td>')
 
+        # parents out of the range of ticket ids are not linked
+        req = MockRequest(self.env, path_info='/newticket',
+                          args={'parents': '1, 99999999999999999999999'})
+        rv = self._dispatch(req)
+        field = [f for f in rv[1]['fields'] if f['name'] == 'parents'][0]
+        self.assertEqual(['1'], re.findall('>#([0-9]+)</a>',
+                                           str(field['rendered'])))
+
+    def test_ticket_view_columns(self):
+        self.config.set('ticket-custom', 'estimate', 'text')
+        self.config.set('subtickets', 'type.task.table_columns',
+                        'estimate,status')
+        with self.env.db_transaction:
+            insert_ticket(self.env, type='defect', summary=u'tíckët 1',
+                    reporter='alice', owner='bob')
+            insert_ticket(self.env, type='task', summary=u'tíckët 1.1',
+                    reporter='bob', owner='bob', parents='1', estimate='3',
+                    status='new')
+            insert_ticket(self.env, type='defect', summary=u'tíckët 1.1.1',
+                    reporter='alice', owner='carol', parents='2',
+                    status='new')
+
+        req = MockRequest(self.env, path_info='/ticket/3')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertNotIn('<table', div)
+
+        req = MockRequest(self.env, path_info='/ticket/1')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertRegex(div, u'<td[^>]*><a[^>]*>#2</a>: tíckët 1\\.1</td>'
+                              u'<td>3</td><td>new</td>')
+        self.assertRegex(div, u'<td style="padding-left: 15px;">'
+                              u'<a[^>]*>#3</a>: tíckët 1\\.1\\.1</td>'
+                              u'<td>new</td><td><a[^>]*>carol</a></td>')
+
+    def test_ticket_view_diamond(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='new', parents='1')
+            insert_ticket(self.env, summary='3', status='new', parents='1')
+            insert_ticket(self.env, summary='4', status='new',
+                          parents='2, 3')
+            insert_ticket(self.env, summary='5', status='new', parents='4')
+
+        req = MockRequest(self.env, path_info='/ticket/1')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertEqual(['2', '4', '5', '3', '4'],
+                         re.findall('>#([0-9]+)</a>', div))
+        self.assertRegex(div, '<td style="padding-left: 15px;"><a[^>]*>#4'
+                              '</a>: 4<span class="subtickets-see-above"> '
+                              '\\(see above\\)</span></td>')
+        self.assertEqual(1, div.count('see above'))
+
+        # #5 is cut off by the depth limit below #2 and #3, so that its
+        # subtree is rendered below #4 without referring to it
+        self.config.set('subtickets', 'recursion_depth', '2')
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='6', status='new', parents='1')
+            insert_ticket(self.env, summary='7', status='new',
+                          parents='4, 6')
+            insert_ticket(self.env, summary='8', status='new', parents='7')
+        req = MockRequest(self.env, path_info='/ticket/1')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertEqual(['2', '4', '5', '7', '3', '4', '6', '7', '8'],
+                         re.findall('>#([0-9]+)</a>', div))
+        self.assertEqual(1, div.count('see above'))
+
+    def test_rollup(self):
+        self.config.set('ticket-custom', 'hours', 'text')
+        self.config.set('ticket-custom', 'hours.label', 'Hours')
+        self.config.set('subtickets', 'rollup', 'enabled')
+        self.config.set('subtickets', 'rollup_fields', 'hours')
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='closed',
+                          parents='1', hours='1.5')
+            insert_ticket(self.env, summary='3', status='new', parents='2',
+                          hours='3')
+
+        req = MockRequest(self.env, path_info='/ticket/1')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertIn('<span class="subtickets-rollup" '
+                      'title="closed: 1, new: 1"> (1/2 closed, Hours: 4.5)'
+                      '</span>', div)
+
+        req = MockRequest(self.env, path_info='/ticket/3')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertNotIn('subtickets-rollup', div)
+
+    def test_fragment_cache(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, type='defect', summary='1', owner='bob',
+                          status='new')
+            insert_ticket(self.env, type='defect', summary='1.1',
+                          owner='bob', status='new', parents='1')
+        module = SubTicketsModule(self.env)
+        calls = []
+        create = module._create_subtickets_table
+        module._create_subtickets_table = \
+            lambda *args, **kwargs: calls.append(1) or create(*args, **kwargs)
+
+        def view():
+            req = MockRequest(self.env, path_info='/ticket/1')
+            self._dispatch(req)
+            return req.chrome['script_data'].get('subtickets_div')
+
+        self.assertIn('>#2</a>: 1.1</td>', view())
+        self.assertIn('>#2</a>: 1.1</td>', view())
+        self.assertEqual(1, len(calls))
+
+        ticket = Ticket(self.env, 2)
+        ticket['summary'] = 'renamed'
+        ticket.save_changes('bob')
+        self.assertIn('>#2</a>: renamed</td>', view())
+        self.assertEqual(2, len(calls))
+
+        insert_ticket(self.env, type='defect', summary='1.2', status='new',
+                      parents='1')
+        self.assertIn('>#3</a>: 1.2</td>', view())
+        self.config.set('subtickets', 'type.defect.table_columns', 'status')
+        self.assertNotIn('>bob</a>', view())
+        self.assertEqual(4, len(calls))
+
+    def test_query_budget(self):
+        # 200 tickets below #1, on two levels
+        relations = [(id_, [1]) for id_ in range(2, 12)]
+        relations += [(id_, [2 + (id_ - 12) // 19])
+                      for id_ in range(12, 202)]
+        insert_hierarchy(self.env, relations)
+        system = SubTicketsSystem(self.env)
+        count = self._count_queries
+
+        for closure, cte, lazy in [('disabled', True, 'disabled'),
+                                   ('disabled', False, 'disabled'),
+                                   ('enabled', None, 'disabled'),
+                                   ('disabled', True, 'enabled')]:
+            self.config.set('subtickets', 'closure_table', closure)
+            self.config.set('subtickets', 'lazy_loading', lazy)
+            system._recursive_cte = cte
+            system._closure_enabled()
+            self.assertLessEqual(count(1), 6)
+            for levels in ('disabled', 'enabled'):
+                self.config.set('subtickets', 'check_all_levels', levels)
+                self.assertLessEqual(count(1, action='resolve'), 5)
+                self.assertLessEqual(count(201, action='reopen'), 5)
+
+    def test_query_budget_deep(self):
+        # a chain of 200 levels below #1
+        insert_hierarchy(self.env, [(id_, [id_ - 1])
+                                    for id_ in range(2, 202)])
+        system = SubTicketsSystem(self.env)
+        for closure, cte in [('disabled', True), ('enabled', None)]:
+            self.config.set('subtickets', 'closure_table', closure)
+            system._recursive_cte = cte
+            system._closure_enabled()
+            self.assertLessEqual(self._count_queries(1), 6)
+            del system._subtree_cache
+            with QueryCounter() as counter:
+                tree, counts = system.get_tree_page(1, limit=1000)
+            self.assertLessEqual(counter.count, 2)
+            self.assertEqual(201, len(counts))
+            self.assertLessEqual(self._count_queries(1, action='resolve'),
+                                 5)
+            self.assertLessEqual(self._count_queries(201, action='reopen'),
+                                 5)
+
+    def test_instrumentation(self):
+        self.config.set('subtickets', 'instrumentation', 'enabled')
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='new', parents='1')
+            insert_ticket(self.env, summary='3', status='new', parents='2')
+        req = MockRequest(self.env, path_info='/ticket/1')
+        with QueryCounter() as counter:
+            self._dispatch(req)
+        self.assertGreater(counter.count, 0)
+
+        # Trac 1.4 and earlier skip request filters of another arity
+        self.assertEqual(4, arity(SubTicketsModule(self.env)
+                                  .post_process_request))
+        stats = SubTicketsSystem(self.env).get_stats()
+        view = stats['SubTicketsModule.post_process_request']
+        self.assertEqual(1, view['count'])
+        self.assertEqual(2, view['nodes'])
+        self.assertGreater(view['queries'], 0)
+        self.assertEqual(1, sum(view['buckets']))
+        # still counted once the test counter is gone
+        self._dispatch(MockRequest(self.env, path_info='/ticket/1'))
+        view = SubTicketsSystem(self.env).get_stats()[
+            'SubTicketsModule.post_process_request']
+        self.assertEqual(2, view['count'])
+        self.assertGreater(view['queries'], view['max_queries'])
+        # three tickets created, two comments added to their parents
+        self.assertEqual(5, stats['SubTicketsSystem.ticket_changed']['count'])
+
+        module = SubTicketsModule(self.env)
+        req = MockRequest(self.env, path_info='/subtickets/stats',
+                          authname='anonymous')
+        self.assertTrue(module.match_request(req))
+        self.assertRaises(PermissionError, module.process_request, req)
+        PermissionSystem(self.env).grant_permission('monitor',
+                                                    'SUBTICKETS_STATS')
+        req = MockRequest(self.env, path_info='/subtickets/stats',
+                          authname='monitor')
+        self.assertRaises(RequestDone, module.process_request, req)
+        content = req.response_sent.getvalue().decode('utf-8')
+        self.assertIn('subtickets_calls_total{'
+                      'hook="SubTicketsModule.post_process_request"} 2\n',
+                      content)
+        self.assertIn('subtickets_seconds_bucket{'
+                      'hook="SubTicketsModule.post_process_request",'
+                      'le="+Inf"} 2\n', content)
+
+    def test_batch_modify(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            for id_ in range(2, 7):
+                insert_ticket(self.env, summary=str(id_), status='new')
+        req = MockRequest(self.env, method='POST', path_info='/batchmodify',
+                          args={'selected_tickets': '2,3,4,5,6',
+                                'batchmod_value_parents': '1',
+                                'batchmod_value_comment': '',
+                                'action': 'leave',
+                                'query_href': '/query'})
+        self.assertRaises(RequestDone, RequestDispatcher(self.env).dispatch,
+                          req)
+        self.assertEqual(['Add subtickets #2, #3, #4, #5, #6.'],
+                         [c[4] for c in Ticket(self.env, 1).get_changelog()
+                          if c[2] == 'comment'])
+        self.assertEqual(5, len(self.env.db_query("SELECT * FROM subtickets")))
+
+    def test_lazy_loading(self):
+        self.config.set('subtickets', 'lazy_loading', 'enabled')
+        with self.env.db_transaction:
+            insert_ticket(self.env, type='defect', summary='1', owner='bob',
+                          status='new')
+            insert_ticket(self.env, type='defect', summary='1.1',
+                          owner='bob', status='new', parents='1')
+            insert_ticket(self.env, type='defect', summary='1.1.1',
+                          owner='carol', status='closed', parents='2')
+
+        req = MockRequest(self.env, path_info='/ticket/1')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertRegex(div, '<tr data-depth="0" data-id="2"><td[^>]*>'
+                              '<span class="subtickets-expander"[^>]*>'
+                              '</span><a[^>]*>#2</a>: 1\\.1</td>')
+        self.assertNotIn('#3', div)
+        self.assertEqual('/trac.cgi/subtickets',
+                         req.chrome['script_data'].get('subtickets_url'))
+
+        req = MockRequest(self.env, path_info='/subtickets/2/children')
+        module = SubTicketsModule(self.env)
+        self.assertTrue(module.match_request(req))
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(
+            [{'id': 3, 'summary': '1.1.1', 'closed': True,
+              'href': '/trac.cgi/ticket/3',
+              'columns': [['closed', None],
+                          ['carol', req.href.query(status='!closed',
+                                                   owner='carol')]],
+              'children': 0}],
+            json.loads(req.response_sent.getvalue().decode('utf-8')))
+
+        req = MockRequest(self.env, path_info='/subtickets/%d/children'
+                                              % (1 << 40))
+        self.assertTrue(module.match_request(req))
+        self.assertRaises(HTTPNotFound, module.process_request, req)
+        req = MockRequest(self.env, path_info='/subtickets/2/children',
+                          args={'offset': str(1 << 40)})
+        self.assertTrue(module.match_request(req))
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual([], json.loads(
+            req.response_sent.getvalue().decode('utf-8')))
+
+    def test_max_rows(self):
+        self.config.set('subtickets', 'table_max_rows', '4')
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            for id_ in range(2, 8):
+                insert_ticket(self.env, summary=str(id_), status='new',
+                              parents='1')
+            for id_ in range(8, 12):
+                insert_ticket(self.env, summary=str(id_), status='new',
+                              parents='2')
+
+        req = MockRequest(self.env, path_info='/ticket/1')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertEqual(['2', '8', '9', '10'],
+                         re.findall('>#([0-9]+)</a>', div))
+        rows = re.findall('<tr class="subtickets-more"([^>]*)>.*?'
+                          '<a href="([^"]*)">([^<]*)</a>', div)
+        self.assertEqual(
+            [(' data-count="1" data-depth="1" data-offset="3" '
+              'data-parent="2"', '/trac.cgi/subtickets/2/children?offset=3',
+              'Show 1 more'),
+             (' data-count="5" data-depth="0" data-offset="1" '
+              'data-parent="1"', '/trac.cgi/subtickets/1/children?offset=1',
+              'Show 5 more')], rows)
+        self.assertEqual(4, req.chrome['script_data'].get(
+                                'subtickets_page_size'))
+        self.assertEqual('Show %(count)s more', req.chrome['script_data']
+                                                .get('subtickets_more_label'))
+
+        # a child past the rows shown only changes the count of the rest
+        insert_ticket(self.env, summary='12', status='new', parents='1')
+        req = MockRequest(self.env, path_info='/ticket/1')
+        self._dispatch(req)
+        div = req.chrome['script_data'].get('subtickets_div')
+        self.assertEqual(['2', '8', '9', '10'],
+                         re.findall('>#([0-9]+)</a>', div))
+        self.assertIn('>Show 6 more</a>', div)
+
+        req = MockRequest(self.env, path_info='/subtickets/1/children',
+                          args={'offset': '1'})
+        module = SubTicketsModule(self.env)
+        self.assertTrue(module.match_request(req))
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual([3, 4, 5, 6], [
+            item['id'] for item in
+            json.loads(req.response_sent.getvalue().decode('utf-8'))])
+
+        # the page size is at least one and at most table_max_rows
+        for limit, expected in (('0', [3]), ('-1', [3]),
+                                ('100', [3, 4, 5, 6])):
+            req = MockRequest(self.env, path_info='/subtickets/1/children',
+                              args={'offset': '1', 'limit': limit})
+            self.assertTrue(module.match_request(req))
+            self.assertRaises(RequestDone, module.process_request, req)
+            self.assertEqual(expected, [
+                item['id'] for item in
+                json.loads(req.response_sent.getvalue().decode('utf-8'))])
+
+    def test_query(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary=u'tíckët 2', status='new',
+                          owner='bob', parents='1')
+            insert_ticket(self.env, summary='3, "three"', status='closed',
+                          owner='carol', parents='1')
+            insert_ticket(self.env, summary='4', status='new', owner='bob',
+                          parents='2')
+        module = SubTicketsModule(self.env)
+
+        req = MockRequest(self.env, path_info='/subtickets/query',
+                          args={'id': '1', 'status': '!closed', 'max': '1',
+                                'order': 'summary', 'desc': '1'})
+        self.assertTrue(module.match_request(req))
+        result = module.process_request(req)
+        self.assertEqual('subtickets_query.html', result[0])
+        content = str(result[1]['content'])
+        self.assertEqual(['2'], re.findall('>#([0-9]+)</a>', content))
+        self.assertIn('<strong>Tickets: 2</strong>', content)
+        self.assertIn('rel="next"', content)
+        self.assertNotIn('rel="prev"', content)
+
+        req = MockRequest(self.env, path_info='/subtickets/query',
+                          args={'id': '1', 'max_depth': '0',
+                                'format': 'csv'})
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(
+            u'id,summary,status,owner,type,milestone\r\n'
+            u'2,tíckët 2,new,bob,defect,\r\n'
+            u'3,"3, ""three""",closed,carol,defect,\r\n',
+            req.response_sent.getvalue().decode('utf-8'))
+
+        for args in ({'id': str(1 << 40)}, {'id': 'x'}, {'id': '0'}):
+            req = MockRequest(self.env, path_info='/subtickets/query',
+                              args=args)
+            self.assertRaises(HTTPBadRequest, module.process_request, req)
+        req = MockRequest(self.env, path_info='/subtickets/query',
+                          args={'id': '1', 'max_depth': str(1 << 40),
+                                'page': str(1 << 40)})
+        content = str(module.process_request(req)[1]['content'])
+        self.assertIn('<strong>Tickets: 3</strong>', content)
+
+        req = MockRequest(self.env, path_info='/subtickets/query',
+                          args={'id': '4', 'direction': 'ancestors',
+                                'col': 'status', 'format': 'csv'})
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual('id,status\r\n1,new\r\n2,new\r\n',
+                         req.response_sent.getvalue().decode('utf-8'))
+
+    def test_export(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='closed',
+                          parents='1')
+            insert_ticket(self.env, summary='3', status='new', parents='2')
+        module = SubTicketsModule(self.env)
+
+        req = MockRequest(self.env, path_info='/subtickets/export',
+                          args={'root': '2', 'fields': 'summary,status'})
+        self.assertTrue(module.match_request(req))
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual(
+            [{'parent': 2, 'child': 3, 'parent_summary': '2',
+              'parent_status': 'closed', 'child_summary': '3',
+              'child_status': 'new'}],
+            [json.loads(line) for line in
+             req.response_sent.getvalue().decode('utf-8').splitlines()])
+
+        req = MockRequest(self.env, path_info='/subtickets/export',
+                          args={'format': 'dot'})
+        self.assertRaises(RequestDone, module.process_request, req)
+        self.assertEqual('digraph subtickets {\n  1 -> 2;\n  2 -> 3;\n}\n',
+                         req.response_sent.getvalue().decode('utf-8'))
+
+        req = MockRequest(self.env, path_info='/subtickets/export',
+                          args={'fields': 'nonexistent'})
+        self.assertRaises(HTTPBadRequest, module.process_request, req)
+        req = MockRequest(self.env, path_info='/subtickets/export',
+                          args={'root': str(1 << 40)})
+        self.assertRaises(HTTPBadRequest, module.process_request, req)
+
+    def test_relations(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='new', parents='1')
+            insert_ticket(self.env, summary='3', status='closed',
+                          parents='1, 2')
+        module = SubTicketsModule(self.env)
+
+        def send(args, etag=None):
+            req = MockRequest(self.env, path_info='/subtickets/relations',
+                              args=args)
+            if etag:
+                req.environ['HTTP_IF_NONE_MATCH'] = etag
+            self.assertTrue(module.match_request(req))
+            with QueryCounter() as counter:
+                self.assertRaises(RequestDone, module.process_request, req)
+            self.assertLessEqual(counter.count, 2)
+            content = req.response_sent.getvalue().decode('utf-8')
+            return (req.status_sent[0], req.headers_sent.get('ETag'),
+                    json.loads(content) if content else None)
+
+        args = {'ids': '1,2, 9, 0, %d' % (1 << 40), 'fields': 'status'}
+        status, etag, data = send(args)
+        self.assertEqual('200 Ok', status)
+        self.assertEqual({'1': {'parents': [], 'children': [2, 3],
+                                'status': 'new'},
+                          '2': {'parents': [1], 'children': [3],
+                                'status': 'new'}}, data)
+        self.assertEqual({'3': {'parents': [1, 2], 'children': []}},
+                         send({'ids': '3'})[2])
+
+        self.assertEqual('304 Not Modified', send(args, etag)[0])
+        self.assertNotEqual(etag, send({'ids': '1,2'})[1])
+        ticket = Ticket(self.env, 3)
+        ticket['parents'] = '1'
+        ticket.save_changes('joe')
+        status, etag, data = send(args, etag)
+        self.assertEqual('200 Ok', status)
+        self.assertEqual([], data['2']['children'])
+        self.assertEqual('304 Not Modified', send(args, etag)[0])
+
+        self.assertRaises(HTTPBadRequest, module.process_request,
+                          MockRequest(self.env,
+                                      path_info='/subtickets/relations',
+                                      args={'ids': '1',
+                                            'fields': 'nonexistent'}))
+
+    def test_validate_resolve(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='new')
+            insert_ticket(self.env, summary='2', status='closed', parents='1')
+            insert_ticket(self.env, summary='3', status='new', parents='1')
+            insert_ticket(self.env, summary='4', status='new', parents='2')
+        module = SubTicketsModule(self.env)
+        req = MockRequest(self.env, args={'action': 'resolve'})
+        for closure in ('disabled', 'enabled'):
+            self.config.set('subtickets', 'closure_table', closure)
+            self.config.set('subtickets', 'check_all_levels', 'disabled')
+            errors = list(module.validate_ticket(req, Ticket(self.env, 1)))
+            self.assertEqual(1, len(errors))
+            self.assertIn('child\n', errors[0][1])
+            self.assertIn('ticket #3 is still open', errors[0][1])
+            self.config.set('subtickets', 'check_all_levels', 'enabled')
+            errors = list(module.validate_ticket(req, Ticket(self.env, 1)))
+            self.assertEqual(
+                [(None, 'Cannot close/resolve because descendant ticket '
+                        '#3 is still open'),
+                 (None, 'Cannot close/resolve because descendant ticket '
+                        '#4 is still open')], errors)
+            self.assertEqual([], list(module.validate_ticket(
+                req, Ticket(self.env, 4))))
+
+    def test_validate_reopen(self):
+        with self.env.db_transaction:
+            insert_ticket(self.env, summary='1', status='closed')
+            insert_ticket(self.env, summary='2', status='new', parents='1')
+            insert_ticket(self.env, summary='3', status='closed', parents='2')
+        module = SubTicketsModule(self.env)
+        req = MockRequest(self.env, args={'action': 'reopen'})
+        self.assertEqual([], list(module.validate_ticket(
+            req, Ticket(self.env, 3))))
+        self.assertEqual(
+            [(None, 'Cannot reopen because parent ticket #1 is closed')],
+            list(module.validate_ticket(req, Ticket(self.env, 2))))
+        self.config.set('subtickets', 'check_all_levels', 'enabled')
+        self.assertEqual(
+            [(None, 'Cannot reopen because ancestor ticket #1 is closed')],
+            list(module.validate_ticket(req, Ticket(self.env, 3))))
+
+    def _count_queries(self, id, action=None):
+        """Count the queries made to show ticket `id`, or to validate
+        `action` on it, with empty caches.
+        """
+        module = SubTicketsModule(self.env)
+        del SubTicketsSystem(self.env)._subtree_cache
+        module._fragments = LRUCache(10)
+        ticket = Ticket(self.env, id)
+        req = MockRequest(self.env, path_info='/ticket/%d' % id,
+                          args={'action': action})
+        with QueryCounter() as counter:
+            if action:
+                list(module.validate_ticket(req, ticket))
+            else:
+                module.post_process_request(req, 'ticket.html',
+                                            {'ticket': ticket}, None)
+        return counter.count
+
     def _dispatch(self, req):
         dispatcher = RequestDispatcher(self.env)
         handler = TicketModule(self.env)
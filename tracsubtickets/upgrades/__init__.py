@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2010, Takashi Ito
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the authors nor the names of its contributors
+#    may be used to endorse or promote products derived from this software
+#    without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Database upgrades of the subtickets schema.
+
+Module `dbN` brings the schema from version `N - 1` to version `N` with
+its `do_upgrade(env, version, cursor)` function.
+"""
+
+import re
+
+from trac.db import DatabaseManager
+
+CREATE_INDEX_RE = re.compile(r'\s*CREATE\s+(UNIQUE\s+)?INDEX\s', re.I)
+
+
+def create_tables(env, cursor, tables):
+    connector = DatabaseManager(env).get_connector()[0]
+    for table in tables:
+        for sql in connector.to_sql(table):
+            cursor.execute(sql)
+
+
+def create_indices(env, cursor, table):
+    connector = DatabaseManager(env).get_connector()[0]
+    for sql in connector.to_sql(table):
+        if CREATE_INDEX_RE.match(sql):
+            cursor.execute(sql)
+
+
+def copy_rows(cursor, src, dst, columns):
+    """Copy `columns` of all rows from table `src` to table `dst` with a
+    single statement, so that the rows never go through the client.
+    """
+    names = ','.join(columns)
+    cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s"
+                   % (dst, names, names, src))
+
+
+def rebuild_table(env, cursor, table):
+    """Recreate `table` with its new definition, keeping the data of the
+    columns it shares with the old definition.
+
+    The old table is renamed, and its rows copied once into the new one.
+    The index and key names of the new definition are dropped from the
+    old table first, where the database does not scope them per table.
+    `table` should not have an auto-increment column, whose sequence
+    keeps its name on PostgreSQL.
+    """
+    cursor.execute("SELECT * FROM %s WHERE 1=0" % table.name)
+    old_columns = [desc[0] for desc in cursor.description]
+    columns = [c.name for c in table.columns if c.name in old_columns]
+    backup = table.name + '_old'
+    cursor.execute("ALTER TABLE %s RENAME TO %s" % (table.name, backup))
+    scheme = DatabaseManager(env).connection_uri.split(':', 1)[0]
+    if scheme == 'postgres':
+        for suffix in ('_pk', '_pkey'):
+            cursor.execute("ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s%s"
+                           % (backup, table.name, suffix))
+    if scheme in ('sqlite', 'postgres'):
+        for index in table.indices:
+            cursor.execute("DROP INDEX IF EXISTS %s_%s_idx"
+                           % (table.name, '_'.join(index.columns)))
+    create_tables(env, cursor, [table])
+    copy_rows(cursor, backup, table.name, columns)
+    cursor.execute("DROP TABLE " + backup)
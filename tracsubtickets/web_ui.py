@@ -27,26 +27,55 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from trac.config import Option, IntOption, ChoiceOption, ListOption
+import json
+import re
+import time
+
+from trac.config import BoolOption, Option, IntOption, FloatOption, ChoiceOption, ListOption
 from trac.core import Component, implements
-from trac.web.api import IRequestFilter
-from trac.web.chrome import ITemplateProvider, add_script, add_script_data, add_stylesheet
+from trac.perm import IPermissionRequestor
+from trac.util import as_int
+from trac.util.datefmt import format_datetime, to_utimestamp, user_time
+from trac.util.text import to_unicode
+from trac.web.api import (HTTPBadRequest, HTTPNotFound, IRequestFilter,
+                          IRequestHandler, RequestDone)
+from trac.web.chrome import ITemplateProvider, add_link, add_script, add_script_data, add_stylesheet
 from trac.util.html import Markup, tag
-from trac.ticket.api import ITicketManipulator
-from trac.ticket.model import Ticket
+from trac.ticket.api import ITicketManipulator, TicketSystem
 from trac.ticket.model import Type as TicketType
-from trac.resource import ResourceNotFound
 from trac.web.chrome import Chrome
 
-from .api import NUMBERS_RE, _
+from .api import (HISTOGRAM_BUCKETS, NUMBERS_RE, LRUCache, SubTicketsSystem,
+                  _, _count_nodes, instrumented)
+from .export import FORMATS, _format_value, csv_lines
 
 
 _use_jinja2 = hasattr(Chrome, 'jenv')
 
+# largest ticket id, beyond which the database raises an error
+MAX_TICKET_ID = 1 << 31
+
+CHILDREN_PATH_RE = re.compile(r'/subtickets/([0-9]+)/children$')
+STATS_PATH = '/subtickets/stats'
+QUERY_PATH = '/subtickets/query'
+EXPORT_PATH = '/subtickets/export'
+RELATIONS_PATH = '/subtickets/relations'
+
+# arguments of the query page which are not field constraints
+QUERY_ARGS = ('id', 'direction', 'max_depth', 'col', 'order', 'desc',
+              'page', 'max', 'format')
+QUERY_COLUMNS = ['summary', 'status', 'owner', 'type', 'milestone']
+QUERY_FILTERS = ['status', 'owner', 'type', 'milestone', 'component',
+                 'priority']
+
+# lines written to the response at once by the CSV and export downloads
+STREAM_CHUNK_SIZE = 500
+
 
 class SubTicketsModule(Component):
 
-    implements(IRequestFilter, ITicketManipulator, ITemplateProvider)
+    implements(IPermissionRequestor, IRequestFilter, IRequestHandler,
+               ITicketManipulator, ITemplateProvider)
 
     # Simple Options
 
@@ -62,6 +91,13 @@ class SubTicketsModule(Component):
          future release of !SubTicketsPlugin.
          """))
 
+    opt_check_all_levels = BoolOption(
+        'subtickets', 'check_all_levels', default='false', doc=_("""
+         If `True`, resolving a ticket is refused while any of its
+         descendants is open, not only its children, and reopening a
+         ticket is refused while any of its ancestors is closed.
+         """))
+
     opt_recursion_depth = IntOption(
         'subtickets', 'recursion_depth', default=-1, doc=_("""
          Limit the number of recursive levels when listing subtickets.
@@ -69,6 +105,29 @@ class SubTicketsModule(Component):
          limits the listing to immediate children.
          """))
 
+    opt_lazy_loading = BoolOption(
+        'subtickets', 'lazy_loading', default='false', doc=_("""
+         If `True`, the subtickets list of a ticket initially shows its
+         children only. The subtickets of a child are fetched when it
+         is expanded, so that large trees are only loaded as far as
+         they are looked at.
+         """))
+
+    opt_max_rows = IntOption(
+        'subtickets', 'table_max_rows', default=1000, doc=_("""
+         Maximum number of rows rendered in the subtickets list of a
+         ticket. The remaining subtickets are replaced by rows showing
+         how many more there are, which load them page by page when
+         clicked. `0` means no limit.
+         """))
+
+    opt_time_budget = FloatOption(
+        'subtickets', 'table_time_budget', default=0, doc=_("""
+         Maximum time in seconds spent rendering the subtickets list of
+         a ticket, after which the remaining subtickets are paged like
+         for `table_max_rows`. `0` means no limit.
+         """))
+
     opt_add_style = ChoiceOption('subtickets', 'add_style', ['button', 'link'],
                                  doc=_("""
          Choose whether to make `Add` look like a button (default) or a link
@@ -81,6 +140,14 @@ class SubTicketsModule(Component):
                            """)
                            )
 
+    opt_fragment_cache_size = IntOption(
+        'subtickets', 'fragment_cache_size', default=100, doc=_("""
+         Number of rendered subtickets tables kept in memory by each
+         process. A table is rendered again once a ticket of the subtree,
+         the subtree itself or the `[subtickets]` configuration changes.
+         `0` disables the cache.
+         """))
+
     # Per-ticket type options -- all initialised in __init__()
 
     opt_inherit_fields = dict()
@@ -107,6 +174,12 @@ class SubTicketsModule(Component):
         # in order to be able to access self.env
         for tt in TicketType.select(self.env):
             self._add_per_ticket_type_option(tt.name)
+        self._fragments = LRUCache(self.opt_fragment_cache_size)
+
+    # IPermissionRequestor methods
+
+    def get_permission_actions(self):
+        return ['SUBTICKETS_STATS']
 
     # ITemplateProvider methods
 
@@ -115,18 +188,395 @@ class SubTicketsModule(Component):
         return [('subtickets', resource_filename(__name__, 'htdocs'))]
 
     def get_templates_dirs(self):
-        return []
+        from pkg_resources import resource_filename
+        return [resource_filename(__name__, 'templates')]
+
+    # IRequestHandler methods
+
+    def match_request(self, req):
+        if req.path_info in (STATS_PATH, QUERY_PATH, EXPORT_PATH,
+                             RELATIONS_PATH):
+            return True
+        match = CHILDREN_PATH_RE.match(req.path_info)
+        if match:
+            req.args['id'] = match.group(1)
+            return True
+        return False
+
+    def process_request(self, req):
+        if req.path_info == STATS_PATH:
+            self._send_stats(req)
+        if req.path_info == QUERY_PATH:
+            return self._process_query(req)
+        if req.path_info == EXPORT_PATH:
+            self._send_export(req)
+        if req.path_info == RELATIONS_PATH:
+            self._send_relations(req)
+        self._send_children(req)
+
+    @instrumented()
+    def _send_children(self, req):
+        id = int(req.args.get('id'))
+        if id > MAX_TICKET_ID:
+            raise HTTPNotFound(_("Ticket %(id)s does not exist.", id=id))
+        req.perm('ticket', id).require('TICKET_VIEW')
+        offset = as_int(req.args.get('offset'), 0, min=0, max=MAX_TICKET_ID)
+        limit = as_int(req.args.get('limit'), None, min=1)
+        if self.opt_max_rows > 0:
+            limit = min(limit or self.opt_max_rows, self.opt_max_rows)
+        system = SubTicketsSystem(self.env)
+        children = system.get_child_ids(id, offset, limit)
+        tickets = self._get_ticket_values(children)
+        counts = system.count_children(children)
+        rows = []
+        for child in children:
+            ticket = tickets.get(child)
+            if ticket is None:
+                continue
+            columns = [(to_unicode(value) if value is not None else '', href)
+                       for value, href in self._get_cells(req, ticket)]
+            rows.append({'id': child, 'summary': ticket['summary'],
+                         'closed': ticket['status'] == 'closed',
+                         'href': req.href.ticket(child),
+                         'columns': columns,
+                         'children': counts.get(child, 0)})
+        self._send_json(req, rows)
+
+    def _send_json(self, req, data):
+        content = json.dumps(data, separators=(',', ':'))
+        req.send(content.encode('utf-8'), 'application/json')
+
+    def _send_stats(self, req):
+        """Send the instrumentation stats of this process in the text
+        format of Prometheus.
+        """
+        req.perm.require('SUBTICKETS_STATS')
+        stats = SubTicketsSystem(self.env).get_stats()
+        lines = []
+        for name in sorted(stats):
+            s = stats[name]
+            label = 'hook="%s"' % name
+            lines.append('subtickets_calls_total{%s} %d' % (label, s['count']))
+            lines.append('subtickets_seconds_total{%s} %f'
+                         % (label, s['seconds']))
+            lines.append('subtickets_seconds_max{%s} %f'
+                         % (label, s['max_seconds']))
+            lines.append('subtickets_queries_total{%s} %d'
+                         % (label, s['queries']))
+            lines.append('subtickets_queries_max{%s} %d'
+                         % (label, s['max_queries']))
+            lines.append('subtickets_tickets_total{%s} %d'
+                         % (label, s['nodes']))
+            count = 0
+            for bound, calls in zip(HISTOGRAM_BUCKETS + ('+Inf',),
+                                    s['buckets']):
+                count += calls
+                lines.append('subtickets_seconds_bucket{%s,le="%s"} %d'
+                             % (label, bound, count))
+        content = ''.join(line + '\n' for line in lines)
+        req.send(content.encode('utf-8'), 'text/plain; version=0.0.4')
+
+    def _process_query(self, req):
+        """List the descendants or ancestors of a ticket, filtered, sorted
+        and paginated by the database, as a page or as CSV.
+        """
+        req.perm.require('TICKET_VIEW')
+        system = SubTicketsSystem(self.env)
+        fields = dict((f['name'], f) for f in
+                      TicketSystem(self.env).get_ticket_fields())
+        id = self._get_ticket_id(req, 'id')
+        ancestors = req.args.get('direction') == 'ancestors'
+        max_depth = as_int(req.args.get('max_depth'), -1, min=-1,
+                           max=MAX_TICKET_ID)
+        cols = [col for col in self._getlist(req, 'col') if col in fields]
+        cols = cols or [col for col in QUERY_COLUMNS if col in fields]
+        order = req.args.get('order')
+        if order != 'id' and order not in fields:
+            order = 'id'
+        desc = req.args.get('desc') == '1'
+        constraints = {}
+        for name in fields:
+            value = '|'.join(self._getlist(req, name))
+            if name not in QUERY_ARGS and value:
+                negate = value.startswith('!')
+                values = value[1:] if negate else value
+                constraints[name] = (negate, values.split('|'))
+
+        query = {'id': id, 'max_depth': max_depth, 'order': order,
+                 'direction': 'ancestors' if ancestors else 'descendants'}
+        if desc:
+            query['desc'] = '1'
+        if cols != [col for col in QUERY_COLUMNS if col in fields]:
+            query['col'] = cols
+        for name, (negate, values) in constraints.items():
+            query[name] = ('!' if negate else '') + '|'.join(values)
+
+        if id is not None:
+            req.perm('ticket', id).require('TICKET_VIEW')
+            if req.args.get('format') == 'csv':
+                rows = system.query_tickets(id, cols, ancestors, max_depth,
+                                            constraints, order, desc)
+                self._send_csv(req, id, rows, cols)
+
+        max_ = as_int(req.args.get('max'),
+                      self.config.getint('query', 'items_per_page', 100),
+                      min=1, max=MAX_TICKET_ID)
+        page = as_int(req.args.get('page'), 1, min=1,
+                      max=MAX_TICKET_ID // max_ + 1)
+        content = tag(self._create_query_form(req, query, constraints,
+                                              fields))
+        if id is not None:
+            total = system.count_tickets(id, ancestors, max_depth,
+                                         constraints)
+            rows = system.query_tickets(id, cols, ancestors, max_depth,
+                                        constraints, order, desc,
+                                        (page - 1) * max_, max_)
+            content.append(self._create_query_results(
+                req, query, rows, cols, fields, total, page, max_))
+            add_link(req, 'alternate',
+                     req.href.subtickets('query', format='csv', **query),
+                     _('Comma-delimited Text'), 'text/plain')
+        add_stylesheet(req, 'subtickets/css/subtickets.css')
+        data = {'title': _('Subtickets Query'), 'content': content}
+        if _use_jinja2:
+            return 'subtickets_query.html', data
+        return 'genshi/subtickets_query.html', data, None
+
+    def _get_ticket_id(self, req, name):
+        """Return the ticket id given by the argument `name`, or `None` if
+        it is missing.
+        """
+        value = req.args.get(name)
+        if not value:
+            return None
+        id = as_int(value, None)
+        if id is None or not 0 < id <= MAX_TICKET_ID:
+            raise HTTPBadRequest(_("Invalid ticket id %(id)s", id=value))
+        return id
+
+    def _getlist(self, req, name):
+        values = req.args.get(name) or []
+        return values if isinstance(values, list) else [values]
+
+    def _create_query_form(self, req, query, constraints, fields):
+        direction = tag.select(
+            [tag.option(label, value=value,
+                        selected=value == query['direction'] or None)
+             for value, label in (('descendants', _('Descendants')),
+                                  ('ancestors', _('Ancestors')))],
+            name='direction')
+        filters = [name for name in QUERY_FILTERS if name in fields]
+        filters += sorted(name for name in constraints
+                          if name not in filters)
+        return tag.form(
+            tag.fieldset(
+                tag.label(_('Ticket:'), ' ',
+                          tag.input(type='text', name='id', size=6,
+                                    value=query['id'])), ' ',
+                tag.label(_('Direction:'), ' ', direction), ' ',
+                tag.label(_('Depth:'), ' ',
+                          tag.input(type='text', name='max_depth', size=3,
+                                    value=query['max_depth'])),
+                tag.p(_('A depth of -1 means unlimited, 0 only the '
+                        'immediate children or parents.'), class_='hint'),
+                tag.table([tag.tr(tag.th(tag.label(fields[name]['label'])),
+                                  tag.td(tag.input(type='text', name=name,
+                                                   value=query.get(name))))
+                           for name in filters]),
+                tag.p(_('Separate values by "|", prefix them with "!" to '
+                        'exclude them.'), class_='hint'),
+                tag.input(type='hidden', name='order',
+                          value=query['order']),
+                tag.input(type='hidden', name='desc',
+                          value=query.get('desc')) if 'desc' in query
+                else None,
+                [tag.input(type='hidden', name='col', value=col)
+                 for col in query.get('col', ())],
+                tag.div(tag.input(type='submit', value=_('Update')),
+                        class_='buttons')),
+            method='get', action=req.href.subtickets('query'),
+            id='subtickets-query')
+
+    def _create_query_results(self, req, query, rows, cols, fields, total,
+                              page, max_):
+        headers = []
+        for name in ['id'] + cols:
+            label = _('Ticket') if name == 'id' else fields[name]['label']
+            args = dict(query, order=name, page=None)
+            args['desc'] = '1' if name == query['order'] and \
+                                  'desc' not in query else None
+            class_ = None
+            if name == query['order']:
+                class_ = 'desc' if 'desc' in query else 'asc'
+            headers.append(tag.th(tag.a(label,
+                                        href=req.href.subtickets('query',
+                                                                 **args)),
+                                  class_=class_))
+        tbody = tag.tbody()
+        for row in rows:
+            id = row[0]
+            if 'TICKET_VIEW' not in req.perm('ticket', id):
+                continue
+            cells = [tag.td(tag.a('#%s' % id, href=req.href.ticket(id)))]
+            for name, value in zip(cols, row[1:]):
+                if fields[name].get('type') == 'time' and value:
+                    value = user_time(req, format_datetime, value)
+                if name == 'summary':
+                    value = tag.a(value, href=req.href.ticket(id))
+                cells.append(tag.td(value))
+            tbody.append(tag.tr(cells))
+
+        paging = tag.p(tag.strong(_('Tickets: %(count)s', count=total)),
+                       class_='subtickets-query-count')
+        last = max((total + max_ - 1) // max_, 1)
+        if page > 1:
+            paging.append([' ', tag.a(_('Previous page'), rel='prev',
+                                      href=req.href.subtickets(
+                                          'query', page=page - 1, **query))])
+        if page < last:
+            paging.append([' ', tag.a(_('Next page'), rel='next',
+                                      href=req.href.subtickets(
+                                          'query', page=page + 1, **query))])
+        return tag(paging,
+                   tag.table(tag.thead(tag.tr(headers)), tbody,
+                             class_='listing tickets'))
+
+    def _send_csv(self, req, id, rows, cols):
+        """Stream the query results as CSV."""
+        def viewable_rows():
+            for row in rows:
+                if 'TICKET_VIEW' in req.perm('ticket', row[0]):
+                    yield row
+        self._send_lines(req, csv_lines(['id'] + cols, viewable_rows()),
+                         'text/csv', 'subtickets-%d.csv' % id)
+
+    def _send_export(self, req):
+        """Stream the relations, all of them or those below the `root`
+        ticket, in the requested format.
+        """
+        req.perm.require('TICKET_VIEW')
+        format = req.args.get('format') or 'ndjson'
+        if format not in FORMATS:
+            raise HTTPBadRequest(_("Unknown format %(format)s",
+                                   format=format))
+        root = self._get_ticket_id(req, 'root')
+        if root is not None:
+            req.perm('ticket', root).require('TICKET_VIEW')
+        system = SubTicketsSystem(self.env)
+        fields = self._get_fields(req)
+
+        def viewable(relations):
+            for relation in relations:
+                if 'TICKET_VIEW' in req.perm('ticket', relation[0]) and \
+                        'TICKET_VIEW' in req.perm('ticket', relation[1]):
+                    yield relation
+        relations = viewable(system.export_relations(root, fields))
+        function, content_type = FORMATS[format]
+        self._send_lines(req, function(relations, fields), content_type,
+                         'subtickets.%s' % format)
+
+    @instrumented()
+    def _send_relations(self, req):
+        """Send the parents and children of the tickets `ids` as JSON,
+        with the values of their `fields` if given.
+
+        The entity tag of the response is computed from the relations and
+        the last changes of the tickets, so that a client sending it back
+        gets a "304 Not Modified" response until one of them changes.
+        """
+        req.perm.require('TICKET_VIEW')
+        ids = set()
+        for value in self._getlist(req, 'ids'):
+            ids.update(int(id) for id in NUMBERS_RE.findall(value)
+                       if 0 < int(id) <= MAX_TICKET_ID)
+        fields = self._get_fields(req)
+        system = SubTicketsSystem(self.env)
+        tickets = system.get_ticket_values(ids,
+                                           set(fields) | set(['changetime']))
+        tickets = dict((id, values) for id, values in tickets.items()
+                       if 'TICKET_VIEW' in req.perm('ticket', id))
+        relations = system.get_relations(tickets)
+        if tickets:
+            req.check_modified(
+                max(values['changetime'] for values in tickets.values()),
+                [fields] + [(id, to_utimestamp(tickets[id]['changetime']),
+                             relations[id]) for id in sorted(tickets)])
+        data = {}
+        for id in sorted(tickets):
+            parents, children = relations[id]
+            item = {'parents': parents, 'children': children}
+            for name in fields:
+                item[name] = _format_value(tickets[id].get(name))
+            data[str(id)] = item
+        self._send_json(req, data)
+
+    def _get_fields(self, req):
+        """Return the field names of the comma-separated `fields`
+        argument.
+        """
+        fields = []
+        for value in self._getlist(req, 'fields'):
+            fields.extend(name.strip() for name in value.split(',')
+                          if name.strip())
+        unknown = set(fields) - \
+                  set(SubTicketsSystem(self.env).get_field_names())
+        if unknown:
+            raise HTTPBadRequest(_("Unknown fields %(fields)s",
+                                   fields=', '.join(sorted(unknown))))
+        return fields
+
+    def _send_lines(self, req, lines, content_type, filename):
+        """Send the text `lines` as an attachment, `STREAM_CHUNK_SIZE`
+        lines at a time.
+        """
+        req.send_response(200)
+        req.send_header('Content-Type', content_type + ';charset=utf-8')
+        req.send_header('Content-Disposition',
+                        'attachment; filename=%s' % filename)
+        req.end_headers()
+        if req.method != 'HEAD':
+            chunk = []
+            for line in lines:
+                chunk.append(line)
+                if len(chunk) == STREAM_CHUNK_SIZE:
+                    req.write(''.join(chunk).encode('utf-8'))
+                    del chunk[:]
+            if chunk:
+                req.write(''.join(chunk).encode('utf-8'))
+        raise RequestDone
 
     # IRequestFilter methods
 
     def pre_process_request(self, req, handler):
+        system = SubTicketsSystem(self.env)
+        # drop whatever an aborted request may have left behind
+        system.end_coalescing(discard=True)
+        if req.path_info == '/batchmodify' and req.method == 'POST':
+            # one comment per parent for the whole batch, saved once the
+            # tickets have been saved and the browser is redirected
+            system.begin_coalescing()
+            req.add_redirect_listener(
+                lambda req, url, permanent: system.end_coalescing())
         return handler
 
     def post_process_request(self, req, template, data, content_type):
+        # Trac 1.4 and earlier only call filters having this exact arity
+        return self._post_process_request(req, template, data,
+                                          content_type)
+
+    @instrumented(result_nodes=lambda result:
+                  _count_nodes((result[1] or {}).get('subtickets')),
+                  name='post_process_request')
+    def _post_process_request(self, req, template, data, content_type):
         path = req.path_info
 
+        if path == '/batchmodify':
+            SubTicketsSystem(self.env).end_coalescing(
+                discard=template is None)
+
         if path.startswith('/ticket/') or path.startswith('/newticket'):
             # get parent ticket's data
+            counts = None
             if data and 'ticket' in data:
                 ticket = data['ticket']
                 parents = ticket['parents'] or ''
@@ -135,7 +585,7 @@ class SubTicketsModule(Component):
                 if len(parents) > 0:
                     self._append_parent_links(req, data, ids)
 
-                children = self.get_children(ticket.id)
+                children, counts = self._get_subtickets(ticket)
                 if children:
                     data['subtickets'] = children
 
@@ -174,18 +624,27 @@ class SubTicketsModule(Component):
                             method="get", action=req.href.newticket())
                 div.append(button)
                 header = tag.h2 if _use_jinja2 else tag.h3
-                div.append(header(_('Subtickets '), link))
+                rollup = None
+                if ticket.exists and children and \
+                        SubTicketsSystem(self.env).opt_rollup:
+                    rollup = self._create_rollup(ticket)
+                div.append(header(_('Subtickets '), link, rollup))
 
             if 'subtickets' in data:
-                # table
-                tbody = tag.tbody()
-                div.append(tag.table(tbody, class_='subtickets'))
-                # tickets
-                self._create_subtickets_table(req, data['subtickets'], tbody)
+                div.append(self._render_subtickets_table(req, ticket,
+                                                         data['subtickets'],
+                                                         counts))
 
             add_stylesheet(req, 'subtickets/css/subtickets.css')
             add_script(req, 'subtickets/js/subtickets.js')
             add_script_data(req, subtickets_div=Markup(div))
+            if self.opt_lazy_loading or self.opt_max_rows > 0 \
+                    or self.opt_time_budget > 0:
+                # the label of the rows added by the script, translated
+                # like those of `_create_more_row`
+                add_script_data(req, subtickets_url=req.href.subtickets(),
+                                subtickets_page_size=self.opt_max_rows,
+                                subtickets_more_label=_("Show %(count)s more"))
 
         elif path.startswith('/admin/ticket/type') \
                 and data \
@@ -195,20 +654,41 @@ class SubTicketsModule(Component):
 
         return template, data, content_type
 
+    def _create_rollup(self, ticket):
+        """Create the summary of the status and the `rollup_fields` of
+        all the descendants of `ticket`.
+        """
+        system = SubTicketsSystem(self.env)
+        fields = system.opt_rollup_fields
+        statuses, sums = system.get_rollup(ticket.id, fields)
+        total = sum(statuses.values())
+        text = [_("%(closed)s/%(total)s closed",
+                  closed=statuses.get('closed', 0), total=total)]
+        labels = dict((f['name'], f['label'])
+                      for f in TicketSystem(self.env).custom_fields)
+        for field in fields:
+            value = ('%.2f' % sums[field]).rstrip('0').rstrip('.')
+            text.append('%s: %s' % (labels.get(field, field), value))
+        title = ', '.join('%s: %s' % (status or _("(none)"), count)
+                          for status, count in sorted(statuses.items()))
+        return tag.span(' (', ', '.join(text), ')', title=title,
+                        class_='subtickets-rollup')
+
     def _append_parent_links(self, req, data, ids):
         links = []
+        ids = [id for id in ids if 0 < int(id) <= MAX_TICKET_ID]
+        tickets = SubTicketsSystem(self.env).get_ticket_values(ids)
         for id in sorted(ids, key=lambda x: int(x)):
-            try:
-                ticket = Ticket(self.env, id)
-                elem = tag.a('#%s' % id,
-                             href=req.href.ticket(id),
-                             class_='%s ticket' % ticket['status'],
-                             title=ticket['summary'])
-                if len(links) > 0:
-                    links.append(', ')
-                links.append(elem)
-            except ResourceNotFound:
-                pass
+            ticket = tickets.get(int(id))
+            if ticket is None:
+                continue
+            elem = tag.a('#%s' % id,
+                         href=req.href.ticket(id),
+                         class_='%s ticket' % ticket['status'],
+                         title=ticket['summary'])
+            if len(links) > 0:
+                links.append(', ')
+            links.append(elem)
         for field in data.get('fields', ''):
             if field.get('name') == 'parents':
                 field['rendered'] = tag.span(*links)
@@ -218,20 +698,24 @@ class SubTicketsModule(Component):
     def prepare_ticket(self, req, ticket, fields, actions):
         pass
 
+    @instrumented(result_nodes=_count_nodes)
     def get_children(self, parent_id, depth=0):
-        children = {}
-
-        for parent, child in self.env.db_query("""
-                SELECT parent, child FROM subtickets WHERE parent=%s
-                """, (parent_id, )):
-            children[child] = None
-
-        if self.opt_recursion_depth > depth or self.opt_recursion_depth == -1:
-            for id in children:
-                children[id] = self.get_children(id, depth + 1)
-
-        return children
+        max_depth = self.opt_recursion_depth
+        if max_depth != -1:
+            max_depth = max(max_depth - depth, 0)
+        return SubTicketsSystem(self.env).get_tree(parent_id, max_depth)
+
+    def _get_subtickets(self, ticket):
+        """Return the descendants of `ticket` listed in its subtickets
+        table and their numbers of children, as `get_tree_page` does.
+        Only the first `table_max_rows` ones are loaded.
+        """
+        max_depth = 0 if self.opt_lazy_loading else self.opt_recursion_depth
+        limit = self.opt_max_rows if self.opt_max_rows > 0 else None
+        return SubTicketsSystem(self.env).get_tree_page(ticket.id, max_depth,
+                                                        limit)
 
+    @instrumented(nodes=lambda req, ticket: 1)
     def validate_ticket(self, req, ticket):
         action = req.args.get('action')
 
@@ -239,30 +723,162 @@ class SubTicketsModule(Component):
             return
 
         if action == 'resolve':
-
-            for parent, child in self.env.db_query("""
-                    SELECT parent, child FROM subtickets WHERE parent=%s
-                    """, (ticket.id, )):
-                if Ticket(self.env, child)['status'] != 'closed':
+            system = SubTicketsSystem(self.env)
+            for child in system.get_open_children(ticket.id,
+                                                  self.opt_check_all_levels):
+                if self.opt_check_all_levels:
+                    yield None, _("Cannot close/resolve because descendant "
+                                  "ticket #%(id)s is still open", id=child)
+                else:
                     yield None, _("""Cannot close/resolve because child
                          ticket #%(child)s is still open""",
                                   child=child)
 
         elif action == 'reopen':
-            ids = set(NUMBERS_RE.findall(ticket['parents'] or ''))
-            for id in ids:
-                if Ticket(self.env, id)['status'] == 'closed':
+            ids = set(int(id) for id in
+                      NUMBERS_RE.findall(ticket['parents'] or ''))
+            system = SubTicketsSystem(self.env)
+            for id in system.get_closed_tickets(ids,
+                                                self.opt_check_all_levels):
+                if id in ids:
                     msg = _("Cannot reopen because parent ticket #%(id)s "
                             "is closed", id=id)
-                    yield None, msg
+                else:
+                    msg = _("Cannot reopen because ancestor ticket "
+                            "#%(id)s is closed", id=id)
+                yield None, msg
+
+    def _get_table_columns(self, ticket_type):
+        return self.env.config.getlist('subtickets',
+                                       'type.%s.table_columns' % ticket_type)
 
-    def _create_subtickets_table(self, req, children, tbody, depth=0):
-        """Recursively create list table of subtickets
+    def _get_ticket_values(self, ids):
+        """Fetch the values needed to render the subtickets table for all
+        of `ids` at once.
+        """
+        system = SubTicketsSystem(self.env)
+        fields = set(['summary', 'status', 'type'])
+        for ticket_type in self.opt_columns:
+            fields.update(self._get_table_columns(ticket_type))
+        tickets = system.get_ticket_values(ids, fields)
+        # tickets of a type without registered options may need more
+        missing = set()
+        for ticket_type in set(t['type'] for t in tickets.values()):
+            missing.update(self._get_table_columns(ticket_type))
+        missing -= fields
+        if missing:
+            for id, values in system.get_ticket_values(tickets,
+                                                       missing).items():
+                tickets[id].update(values)
+        return tickets
+
+    @instrumented(nodes=lambda req, ticket, children, counts=None:
+                  _count_nodes(children))
+    def _render_subtickets_table(self, req, ticket, children, counts=None):
+        """Return the subtickets table of `ticket` as markup, `counts`
+        giving the number of children of the tickets expanded in
+        `children`, which may list only the first ones.
+
+        The markup rendered by an earlier request is reused as long as the
+        tickets of the subtree, its structure and the configuration are
+        unchanged.
+        """
+        system = SubTicketsSystem(self.env)
+        expandable = None
+        if self.opt_lazy_loading:
+            expandable = system.count_children(children)
+        ids = set()
+        structure = []
+        stack = [(children, 0)]
+        while stack:
+            nodes, depth = stack.pop()
+            for id in sorted(nodes, reverse=True):
+                ids.add(id)
+                structure.append((id, depth, nodes[id] is None))
+                if nodes[id]:
+                    stack.append((nodes[id], depth + 1))
+        key = (ticket.id, ticket['type'], req.href(), str(req.locale),
+               tuple(self.config.options('subtickets')))
+        stamp = (system.get_last_change(ids), tuple(structure),
+                 tuple(sorted(expandable.items())) if expandable else None,
+                 tuple(sorted(counts.items())) if counts else None)
+        cached = self._fragments.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        tbody = tag.tbody()
+        timed_out = self._create_subtickets_table(req, children, tbody,
+                                                  expandable=expandable,
+                                                  parent=ticket.id,
+                                                  counts=counts)
+        table = Markup(tag.table(tbody, class_='subtickets'))
+        # where the time budget ran out depends on the load
+        if not timed_out:
+            self._fragments.set(key, (stamp, table))
+        return table
+
+    def _create_subtickets_table(self, req, children, tbody, depth=0,
+                                 tickets=None, expandable=None, parent=None,
+                                 counts=None):
+        """Create list table of subtickets
+
+        The children listed in `expandable`, a `{id: count}` dictionary,
+        get an expander to load their own children on demand. A ticket
+        listed again after its subtree was rendered is marked as shown
+        above, whereas a ticket cut off by `recursion_depth` is not.
+
+        Once `table_max_rows` rows are rendered or `table_time_budget` is
+        spent, the remaining children of each open level are replaced by
+        a row loading them page by page. `parent` is the ticket whose
+        `children` are listed. The children left out of `children` are
+        replaced the same way, given their numbers in `counts`, a
+        `{id: count}` dictionary. Return `True` if the time budget ran
+        out.
         """
         if not children:
-            return
-        for id in sorted(children, key=lambda x: int(x)):
-            ticket = Ticket(self.env, id)
+            return False
+        if tickets is None:
+            ids = set()
+            stack = [children]
+            while stack:
+                nodes = stack.pop()
+                ids.update(nodes)
+                stack.extend(n for n in nodes.values() if n)
+            tickets = self._get_ticket_values(ids)
+
+        max_rows = self.opt_max_rows
+        deadline = None
+        if self.opt_time_budget > 0:
+            deadline = time.time() + self.opt_time_budget
+        rows = 0
+        expanded = set()
+        stack = [(parent, children, sorted(children, key=lambda x: int(x),
+                                           reverse=True), depth)]
+
+        def append_more_row(parent, nodes, ids, depth):
+            if parent is None:
+                return
+            offset = len(nodes) - len(ids)
+            count = counts.get(int(parent), len(nodes)) if counts \
+                else len(nodes)
+            if count > offset:
+                tbody.append(self._create_more_row(req, parent, offset,
+                                                   count - offset, depth))
+
+        while stack:
+            parent, nodes, ids, depth = stack[-1]
+            if not ids:
+                stack.pop()
+                append_more_row(parent, nodes, ids, depth)
+                continue
+            timed_out = deadline is not None and time.time() > deadline
+            if 0 < max_rows <= rows or timed_out:
+                for level in reversed(stack):
+                    append_more_row(*level)
+                return timed_out
+            id = ids.pop()
+            ticket = tickets.get(int(id))
+            if ticket is None:
+                continue
 
             # the row
             r = []
@@ -271,30 +887,73 @@ class SubTicketsModule(Component):
             if ticket['status'] == 'closed':
                 attrs['class_'] = 'closed'
             link = tag.a('#%s' % id, **attrs)
-            summary = tag.td(link, ': %s' % ticket['summary'],
+            expander = reference = None
+            if nodes[id] is not None:
+                expanded.add(int(id))
+            elif int(id) in expanded:
+                # the subtree of a ticket with several parents is only
+                # listed under the first one
+                reference = tag.span(' ', _("(see above)"),
+                                     class_='subtickets-see-above')
+            elif expandable and expandable.get(int(id)):
+                expander = tag.span(class_='subtickets-expander',
+                                    title=_("Show subtickets"),
+                                    **{'data-count': expandable[int(id)]})
+            summary = tag.td(expander, link, ': %s' % ticket['summary'],
+                             reference,
                              style='padding-left: %dpx;' % (depth * 15))
             r.append(summary)
 
             # Add other columns as configured.
-            for column in \
-                    self.env.config.getlist('subtickets',
-                                            'type.%(type)s.table_columns'
-                                            % ticket):
-                if column == 'owner':
-                    if self.opt_owner_url:
-                        href = req.href(self.opt_owner_url % ticket['owner'])
-                    else:
-                        href = req.href.query(status='!closed',
-                                              owner=ticket['owner'])
-                    e = tag.td(tag.a(ticket['owner'], href=href))
-                elif column == 'milestone':
-                    href = req.href.query(status='!closed',
-                                          milestone=ticket['milestone'])
-                    e = tag.td(tag.a(ticket['milestone'],
-                                     href=href))
+            for value, href in self._get_cells(req, ticket):
+                if href is not None:
+                    r.append(tag.td(tag.a(value, href=href)))
                 else:
-                    e = tag.td(ticket[column])
-                r.append(e)
-            tbody.append(tag.tr(*r))
+                    r.append(tag.td(value))
+            if expandable is not None:
+                tbody.append(tag.tr(*r, **{'data-id': id,
+                                          'data-depth': depth}))
+            else:
+                tbody.append(tag.tr(*r))
+            rows += 1
+
+            if nodes[id]:
+                stack.append((id, nodes[id], sorted(nodes[id],
+                                                    key=lambda x: int(x),
+                                                    reverse=True),
+                              depth + 1))
+        return False
+
+    def _create_more_row(self, req, parent, offset, count, depth):
+        """Create the row standing for the `count` children of `parent`
+        following the first `offset` ones.
+        """
+        link = tag.a(_("Show %(count)s more", count=count),
+                     href=req.href.subtickets(parent, 'children',
+                                              offset=offset))
+        return tag.tr(tag.td(link, style='padding-left: %dpx;' % (depth * 15)),
+                      class_='subtickets-more',
+                      **{'data-parent': parent, 'data-offset': offset,
+                         'data-count': count, 'data-depth': depth})
+
+    def _get_cells(self, req, ticket):
+        """Return the `(value, href)` pairs of the configured columns of a
+        row, where `href` is `None` for a plain value.
+        """
+        cells = []
+        for column in self._get_table_columns(ticket['type']):
+            if column == 'owner':
+                if self.opt_owner_url:
+                    href = req.href(self.opt_owner_url % ticket['owner'])
+                else:
+                    href = req.href.query(status='!closed',
+                                          owner=ticket['owner'])
+                cells.append((ticket['owner'], href))
+            elif column == 'milestone':
+                href = req.href.query(status='!closed',
+                                      milestone=ticket['milestone'])
+                cells.append((ticket['milestone'], href))
+            else:
+                cells.append((ticket.get(column), None))
+        return cells
 
-            self._create_subtickets_table(req, children[id], tbody, depth + 1)